@@ -1,9 +1,8 @@
-from datetime import datetime
-from pathlib import Path
+from operator import itemgetter
 from sys import breakpointhook
 
 # Cardano-Tools components
-from .shelley_tools import ShelleyTools
+from .shelley_tools import ShelleyTools, _tx_name
 
 
 class MaryError(Exception):
@@ -38,7 +37,7 @@ class MaryTools:
 
         # Get a list of UTxOs for the transaction
         utxos = []
-        input_str = ""
+        input_parts = []
         input_lovelace = 0
         for i, asset in enumerate(send_assets.keys()):
 
@@ -60,16 +59,20 @@ class MaryTools:
                     # If this is a unique UTxO being added to the list, keep
                     # track of the total Lovelaces and add it to the
                     # transaction input string.
-                    input_lovelace += int(utxo["Lovelace"])
-                    input_str += f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
+                    input_lovelace += utxo["Lovelace"]
+                    input_parts.append(
+                        f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
+                    )
 
-                asset_count += int(utxo[asset])
+                asset_count += utxo[asset]
                 if asset_count >= quantities[i]:
                     break
 
             if asset_count < quantities[i]:
                 raise MaryError(f"Not enought {asset} tokens availible.")
 
+        input_str = "".join(input_parts)
+
         # If we get to this point, we have enough UTxOs to cover the requested
         # tokens. Next we need to build lists of the output and return tokens.
         output_tokens = {}
@@ -82,9 +85,9 @@ class MaryTools:
                 elif k in send_assets:
                     # These are the native assets requested.
                     if k in output_tokens:
-                        output_tokens[k] += int(utxo[k])
+                        output_tokens[k] += utxo[k]
                     else:
-                        output_tokens[k] = int(utxo[k])
+                        output_tokens[k] = utxo[k]
 
                     # If the UTxOs selected for the transaction contain more
                     # tokens than requested, clip the number of output tokens
@@ -96,9 +99,9 @@ class MaryTools:
                     # These are tokens that are not being requested so they just
                     # need to go back to the wallet in another output.
                     if k in return_tokens:
-                        return_tokens[k] += int(utxo[k])
+                        return_tokens[k] += utxo[k]
                     else:
-                        return_tokens[k] = int(utxo[k])
+                        return_tokens[k] = utxo[k]
 
         # Note: at this point output_tokens should be the same as send_assets.
         # It was necessary to build another dict of output tokens as we
@@ -248,14 +251,7 @@ class MaryTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.shelley.working_dir
-        else:
-            folder = Path(folder)
-            if self.shelley.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.shelley._ShelleyTools__run(f'mkdir -p "{folder}"')
+        folder = self.shelley._ensure_folder(folder)
 
         # Make sure the qunatity is positive.
         quantity = abs(quantity)
@@ -271,12 +267,12 @@ class MaryTools:
         )
 
         # Build token input and output strings
-        output_token_utxo_str = ""
-        for token in output_tokens.keys():
-            output_token_utxo_str += f" + {output_tokens[token]} {token}"
-        return_token_utxo_str = ""
-        for token in return_tokens.keys():
-            return_token_utxo_str += f" + {return_tokens[token]} {token}"
+        output_token_utxo_str = "".join(
+            f" + {amt} {token}" for token, amt in output_tokens.items()
+        )
+        return_token_utxo_str = "".join(
+            f" + {amt} {token}" for token, amt in return_tokens.items()
+        )
 
         # Calculate the minimum ADA for the token UTxOs.
         min_utxo_out = self.calc_min_utxo(output_tokens.keys())
@@ -291,8 +287,7 @@ class MaryTools:
             utxo_ret = 0
 
         # Determine the TTL
-        tip = self.shelley.get_tip()
-        ttl = tip + self.shelley.ttl_buffer
+        ttl = self.shelley.get_ttl()
 
         # Ensure the parameters file exists
         self.shelley.load_protocol_parameters()
@@ -304,11 +299,11 @@ class MaryTools:
         # Get a list of Lovelace only UTxOs and sort them in ascending order
         # by value. We may not end up needing these.
         ada_utxos = self.shelley.get_utxos(from_addr, filter="Lovelace")
-        ada_utxos.sort(key=lambda k: k["Lovelace"], reverse=False)
+        ada_utxos.sort(key=itemgetter("Lovelace"), reverse=False)
 
         # Create a name for the transaction files.
-        tx_name = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.shelley.working_dir) / (tx_name + ".draft")
+        tx_name = _tx_name("tx")
+        tx_draft_file = self.shelley.working_dir / (tx_name + ".draft")
 
         # Create a TX out string given the possible scenarios.
         use_ada_utxo = False
@@ -336,18 +331,30 @@ class MaryTools:
                 use_ada_utxo = True
 
         # Calculate the minimum transaction fee as it is right now with only the
-        # minimum UTxOs needed for the tokens.
-        self.shelley.run_cli(
-            f"{self.shelley.cli} transaction build-raw {input_str}"
+        # minimum UTxOs needed for the tokens. Only the inputs of the draft
+        # change below.
+        draft_head = f"{self.shelley.cli} transaction build-raw "
+        draft_tail = (
             f"{output_str} --ttl 0 --fee 0 {meta_str} "
             f"{self.shelley.era} --out-file {tx_draft_file}"
         )
+        # The fee estimate used to skip drafts below is calibrated with the
+        # exact fees. The size of the token strings stands in for the size of
+        # the tokens so token transactions are calibrated separately from
+        # ADA-only ones.
+        token_in_count = input_str.count("--tx-in ")
+        tx_out_count = output_str.count("--tx-out ")
+        token_bytes = len(output_token_utxo_str) + len(return_token_utxo_str)
+        self.shelley.run_cli(draft_head + input_str + draft_tail)
         min_fee = self.shelley.calc_min_fee(
             tx_draft_file,
-            input_str.count("--tx-in "),
-            tx_out_count=output_str.count("--tx-out "),
+            token_in_count,
+            tx_out_count=tx_out_count,
             witness_count=1,
         )
+        self.shelley.calibrate_fee_estimate(
+            min_fee, token_in_count, tx_out_count, 1, token_bytes
+        )
 
         # If we don't have enough ADA, we will have to add another UTxO to cover
         # the transaction fees.
@@ -355,21 +362,33 @@ class MaryTools:
 
             # Iterate through the UTxOs until we have enough funds to cover the
             # transaction. Also, update the tx_in string for the transaction.
+            input_parts = [input_str]
             for idx, utxo in enumerate(ada_utxos):
-                input_lovelace += int(utxo["Lovelace"])
-                input_str += f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
-
-                self.shelley.run_cli(
-                    f"{self.shelley.cli} transaction build-raw {input_str}"
-                    f"{output_str} --ttl 0 --fee 0 {meta_str} "
-                    f"{self.shelley.era} --out-file {tx_draft_file}"
+                input_lovelace += utxo["Lovelace"]
+                input_parts.append(f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} ")
+                tx_in_count = token_in_count + idx + 1
+
+                # Skip the draft while even the estimated fee is not covered.
+                # The last UTxO is always drafted so the fee is exact below.
+                est_fee = self.shelley.estimate_min_fee(
+                    tx_in_count, tx_out_count, 1, token_bytes
                 )
+                if idx + 1 < len(ada_utxos) and input_lovelace < (
+                    est_fee + utxo_ret + utxo_out
+                ):
+                    continue
+
+                input_str = "".join(input_parts)
+                self.shelley.run_cli(draft_head + input_str + draft_tail)
                 min_fee = self.shelley.calc_min_fee(
                     tx_draft_file,
-                    input_str.count("--tx-in "),
-                    tx_out_count=output_str.count("--tx-out "),
+                    tx_in_count,
+                    tx_out_count=tx_out_count,
                     witness_count=1,
                 )
+                self.shelley.calibrate_fee_estimate(
+                    min_fee, tx_in_count, tx_out_count, 1, token_bytes
+                )
 
                 # If we don't have enough ADA here, then go ahead and add another
                 # ADA only UTxO.
@@ -385,7 +404,7 @@ class MaryTools:
                 ):
 
                     self.shelley.run_cli(
-                        f"{self.shelley.cli} transaction build-raw {input_str}"
+                        f"{draft_head}{input_str}"
                         f"{output_str} --tx-out {from_addr}+0 "
                         f"--ttl 0 --fee 0 {meta_str} "
                         f"{self.shelley.era} --out-file {tx_draft_file}"
@@ -434,7 +453,7 @@ class MaryTools:
         token_return_ada_str = ""
         if utxo_ret_ada > 0:
             token_return_ada_str = f"--tx-out {from_addr}+{utxo_ret_ada}"
-        tx_raw_file = Path(self.shelley.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.shelley.working_dir / (tx_name + ".raw")
 
         self.shelley.run_cli(
             f"{self.shelley.cli} transaction build-raw {input_str}"
@@ -509,14 +528,7 @@ class MaryTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.shelley.working_dir
-        else:
-            folder = Path(folder)
-            if self.shelley.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.shelley._ShelleyTools__run(f'mkdir -p "{folder}"')
+        folder = self.shelley._ensure_folder(folder)
 
         # Make sure all names are unique and the quantities match the names.
         # Giving a name is optional. So, if no names, one quantitiy value is
@@ -535,13 +547,12 @@ class MaryTools:
         # Get a list of ADA only UTXOs and sort them in ascending order by
         # value.
         utxos = self.shelley.get_utxos(payment_addr, filter="Lovelace")
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        utxos.sort(key=itemgetter("Lovelace"), reverse=True)
         if len(utxos) < 1:
             raise MaryError("No ADA only UTxOs for minting.")
 
         # Determine the TTL
-        tip = self.shelley.get_tip()
-        ttl = tip + self.shelley.ttl_buffer
+        ttl = self.shelley.get_ttl()
 
         # Ensure the parameters file exists
         self.shelley.load_protocol_parameters()
@@ -558,13 +569,13 @@ class MaryTools:
         print(utxo_out)
 
         # Create minting string
-        mint_str = ""
         if len(asset_names) == 0:
-            mint_str += f"{quantities[0]} {policy_id}"
+            mint_str = f"{quantities[0]} {policy_id}"
         else:
-            for i, name in enumerate(asset_names):
-                sep = " + " if i != 0 else ""
-                mint_str += f"{sep}{quantities[i]} {policy_id}.{name}"
+            mint_str = " + ".join(
+                f"{amt} {policy_id}.{name}"
+                for name, amt in zip(asset_names, quantities)
+            )
 
         # Create a metadata string
         meta_str = ""
@@ -574,8 +585,8 @@ class MaryTools:
         # Create a minting script string
         script_str = f"--minting-script-file {minting_script}"
 
-        tx_name = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.shelley.working_dir) / (tx_name + ".draft")
+        tx_name = _tx_name("tx")
+        tx_draft_file = self.shelley.working_dir / (tx_name + ".draft")
 
         # Iterate through the ADA only UTxOs until we have enough funds to
         # cover the transaction. Also, create the tx_in string for the
@@ -583,21 +594,40 @@ class MaryTools:
         utxo_ret_ada = 0
         utxo_total = 0
         tx_in_str = ""
+        tx_in_parts = []
+        draft_head = f"{self.shelley.cli} transaction build-raw "
+        draft_tail = (
+            f"--ttl 0 --fee 0 "
+            f'--mint "{mint_str}" {script_str} {meta_str} '
+            f"{self.shelley.era} --out-file {tx_draft_file}"
+        )
+
+        # The size of the mint string stands in for the size of the tokens in
+        # the fee estimate, so minting transactions are calibrated separately
+        # from ADA-only ones.
+        token_bytes = len(mint_str)
         for idx, utxo in enumerate(utxos):
             # Add an availible UTxO to the list and then check to see if we now
             # have enough lovelaces to cover the transaction fees and what we
             # want with the tokens.
             utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
+            utxo_total += utxo["Lovelace"]
+            tx_in_parts.append(f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} ")
+
+            # Skip the draft while even the estimated fee is not covered. The
+            # last UTxO is always drafted so the fee is exact below.
+            est_fee = self.shelley.estimate_min_fee(
+                utxo_count, 1, witness_count, token_bytes
+            )
+            if utxo_count < len(utxos) and utxo_total < est_fee + utxo_out:
+                continue
 
             # Build a transaction draft with a single output.
+            tx_in_str = "".join(tx_in_parts)
             self.shelley.run_cli(
-                f"{self.shelley.cli} transaction build-raw {tx_in_str}"
+                f"{draft_head}{tx_in_str}"
                 f'--tx-out "{payment_addr}+{utxo_total}+{mint_str}" '
-                f"--ttl 0 --fee 0 "
-                f'--mint "{mint_str}" {script_str} {meta_str} '
-                f"{self.shelley.era} --out-file {tx_draft_file}"
+                f"{draft_tail}"
             )
 
             # Calculate the minimum fee for the transaction with a single
@@ -608,6 +638,9 @@ class MaryTools:
                 tx_out_count=1,
                 witness_count=witness_count,
             )
+            self.shelley.calibrate_fee_estimate(
+                min_fee, utxo_count, 1, witness_count, token_bytes
+            )
 
             # If we don't have enough ADA here, then go ahead and add another
             # ADA only UTxO.
@@ -620,11 +653,9 @@ class MaryTools:
 
                 # Create a draft transaction with an extra ADA only UTxO.
                 self.shelley.run_cli(
-                    f"{self.shelley.cli} transaction build-raw {tx_in_str}"
+                    f"{draft_head}{tx_in_str}"
                     f'--tx-out "{payment_addr}+{utxo_total}+{mint_str}" '
-                    f'--tx-out "{payment_addr}+0" --ttl 0 --fee 0 '
-                    f'--mint "{mint_str}" {script_str} {meta_str} '
-                    f"{self.shelley.era} --out-file {tx_draft_file}"
+                    f'--tx-out "{payment_addr}+0" {draft_tail}'
                 )
 
                 # Calculate the minimum fee for the transaction with an extra
@@ -635,6 +666,9 @@ class MaryTools:
                     tx_out_count=2,
                     witness_count=witness_count,
                 )
+                self.shelley.calibrate_fee_estimate(
+                    min_fee, utxo_count, 2, witness_count, token_bytes
+                )
 
                 # Save the amount of ADA that we are returning in a separate
                 # UTxO.
@@ -664,7 +698,7 @@ class MaryTools:
         token_return_ada_str = ""
         if utxo_ret_ada > 0:
             token_return_ada_str = f"--tx-out {payment_addr}+{utxo_ret_ada}"
-        tx_raw_file = Path(self.shelley.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.shelley.working_dir / (tx_name + ".raw")
         print(utxo_out)
         self.shelley.run_cli(
             f"{self.shelley.cli} transaction build-raw {tx_in_str}"
@@ -726,14 +760,7 @@ class MaryTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.shelley.working_dir
-        else:
-            folder = Path(folder)
-            if self.shelley.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.shelley._ShelleyTools__run(f'mkdir -p "{folder}"')
+        folder = self.shelley._ensure_folder(folder)
 
         # Make sure all names are unique and the quantities match the names.
         # Giving a name is optional. So, if no names, one quantitiy value is
@@ -763,8 +790,7 @@ class MaryTools:
         )
 
         # Determine the TTL
-        tip = self.shelley.get_tip()
-        ttl = tip + self.shelley.ttl_buffer
+        ttl = self.shelley.get_ttl()
 
         # Ensure the parameters file exists
         self.shelley.load_protocol_parameters()
@@ -772,13 +798,12 @@ class MaryTools:
 
         # Create transaction strings for the tokens. The minting input string
         # and the UTxO string for any remaining tokens.
-        burn_str = ""
-        token_utxo_str = ""
-        for i, asset in enumerate(output_tokens.keys()):
-            sep = " + " if i != 0 else " "
-            burn_str += f"{sep}{-1*output_tokens[asset]} {asset}"
-        for asset in return_tokens.keys():
-            token_utxo_str += f" + {return_tokens[asset]} {asset}"
+        burn_str = " " + " + ".join(
+            f"{-1*amt} {asset}" for asset, amt in output_tokens.items()
+        )
+        token_utxo_str = "".join(
+            f" + {amt} {asset}" for asset, amt in return_tokens.items()
+        )
 
         # Create a metadata string
         meta_str = ""
@@ -787,20 +812,33 @@ class MaryTools:
 
         # Calculate the minimum fee and UTxO sizes for the transaction as it is
         # right now with only the minimum UTxOs needed for the tokens.
-        tx_name = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.shelley.working_dir) / (tx_name + ".draft")
-        self.shelley.run_cli(
-            f"{self.shelley.cli} transaction build-raw {input_str}"
-            f'--tx-out "{payment_addr}+{input_lovelace}{token_utxo_str}" '
+        tx_name = _tx_name("tx")
+        tx_draft_file = self.shelley.working_dir / (tx_name + ".draft")
+        draft_head = f"{self.shelley.cli} transaction build-raw "
+        draft_tail = (
             f'--ttl 0 --fee 0 --mint "{burn_str}" {meta_str} '
             f"{self.shelley.era} --out-file {tx_draft_file}"
         )
+        self.shelley.run_cli(
+            f"{draft_head}{input_str}"
+            f'--tx-out "{payment_addr}+{input_lovelace}{token_utxo_str}" '
+            f"{draft_tail}"
+        )
         min_fee = self.shelley.calc_min_fee(
             tx_draft_file,
             utxo_count := input_str.count("--tx-in "),
             tx_out_count=1,
             witness_count=witness_count,
         )
+
+        # The fee estimate used to skip drafts below is calibrated with the
+        # exact fees. The size of the token strings stands in for the size of
+        # the tokens so burning transactions are calibrated separately from
+        # ADA-only ones.
+        token_bytes = len(burn_str) + len(token_utxo_str)
+        self.shelley.calibrate_fee_estimate(
+            min_fee, utxo_count, 1, witness_count, token_bytes
+        )
         min_utxo_ret = self.calc_min_utxo(return_tokens.keys())
 
         # If we don't have enough ADA, we will have to add another UTxO to cover
@@ -810,21 +848,32 @@ class MaryTools:
             # Get a list of Lovelace only UTxOs and sort them in ascending order
             # by value.
             ada_utxos = self.shelley.get_utxos(payment_addr, filter="Lovelace")
-            ada_utxos.sort(key=lambda k: k["Lovelace"], reverse=False)
+            ada_utxos.sort(key=itemgetter("Lovelace"), reverse=False)
 
             # Iterate through the UTxOs until we have enough funds to cover the
             # transaction. Also, update the tx_in string for the transaction.
-            for utxo in ada_utxos:
+            input_parts = [input_str]
+            for idx, utxo in enumerate(ada_utxos):
                 utxo_count += 1
-                input_lovelace += int(utxo["Lovelace"])
-                input_str += f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
+                input_lovelace += utxo["Lovelace"]
+                input_parts.append(f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} ")
+
+                # Skip the draft while even the estimated fee is not covered.
+                # The last UTxO is always drafted so the fee is exact below.
+                est_fee = self.shelley.estimate_min_fee(
+                    utxo_count, 1, witness_count, token_bytes
+                )
+                if idx + 1 < len(ada_utxos) and input_lovelace <= (
+                    est_fee + min_utxo_ret
+                ):
+                    continue
 
                 # Build a transaction draft
+                input_str = "".join(input_parts)
                 self.shelley.run_cli(
-                    f"{self.shelley.cli} transaction build-raw {input_str}"
+                    f"{draft_head}{input_str}"
                     f'--tx-out "{payment_addr}+{input_lovelace}{token_utxo_str}" '
-                    f'--ttl 0 --fee 0 --mint "{burn_str}" {meta_str} '
-                    f"{self.shelley.era} --out-file {tx_draft_file}"
+                    f"{draft_tail}"
                 )
 
                 # Calculate the minimum fee
@@ -834,6 +883,9 @@ class MaryTools:
                     tx_out_count=1,
                     witness_count=witness_count,
                 )
+                self.shelley.calibrate_fee_estimate(
+                    min_fee, utxo_count, 1, witness_count, token_bytes
+                )
 
                 # If we have enough Lovelaces to cover the transaction, we can stop
                 # iterating through the UTxOs.
@@ -852,7 +904,7 @@ class MaryTools:
         if utxo_amt < min_utxo:
             min_fee = utxo_amt
             utxo_amt = 0
-        tx_raw_file = Path(self.shelley.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.shelley.working_dir / (tx_name + ".raw")
         self.shelley.run_cli(
             f"{self.shelley.cli} transaction build-raw {input_str}"
             f'--tx-out "{payment_addr}+{utxo_amt}{token_utxo_str}" '
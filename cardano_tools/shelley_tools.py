@@ -1,13 +1,346 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
+from paramiko import SSHException
+import functools
+import hashlib
+import itertools
+import logging
+import mmap
 import subprocess
+import threading
+import asyncio
 import requests
+import shutil
 import shlex
 import json
+import re
+import time
 import sys
 import os
 
+try:
+    import orjson  # Optional, faster JSON parsing and serialization.
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+# Process-wide pool of SSH connections keyed by the connection parameters.
+# ShelleyTools objects pointed at the same remote host share one connection
+# instead of each paying for their own handshake. A connection is used from
+# several threads at once, so closing and reopening it is serialized by a lock
+# per connection (same keys). A connection is only closed by `close` once the
+# last ShelleyTools object using it is closed.
+_SSH_POOL = {}
+_SSH_POOL_LAST_USED = {}
+_SSH_POOL_USERS = {}
+_SSH_POOL_CONN_LOCKS = {}
+_SSH_POOL_LOCK = threading.Lock()
+_SSH_POOL_IDLE_TIMEOUT = 300  # seconds
+_SSH_POOL_REAPER = None
+
+
+# Result of a CLI command.
+CliResult = namedtuple("Result", "stdout, stderr, returncode")
+
+# A line of the UTXO table printed by "query utxo" and the extra tokens in its
+# tail, e.g. "<TxHash> <TxIx> <Lovelace> lovelace + <amount> <policy.name>".
+# The tokens are the leading run of "+ <amount> <asset>" groups; whatever
+# follows them (e.g. "+ TxOutDatumHash ...") is not a token.
+_UTXO_LINE_RE = re.compile(
+    r"^(\S+)[ \t]+(\d+)[ \t]+(\d+)(?:[ \t]+lovelace)?(.*)$", re.M
+)
+_ASSETS_RE = re.compile(r"(?:\s*\+\s+\d+\s+\S+)*")
+_ASSET_RE = re.compile(r"\+\s+(\d+)\s+(\S+)")
+
+# The slot number in the JSON printed by "query tip", which is the only field
+# used from it.
+_SLOT_RE = re.compile(r'"slot"\s*:\s*(\d+)')
+
+# The text envelope types of the verification keys whose hash is the
+# blake2b-224 digest of the key bytes, i.e. the keys "address key-hash" takes.
+_KEY_HASH_VKEY_TYPES = frozenset(
+    {
+        "PaymentVerificationKeyShelley_ed25519",
+        "PaymentExtendedVerificationKeyShelley_ed25519",
+        "StakeVerificationKeyShelley_ed25519",
+        "StakeExtendedVerificationKeyShelley_ed25519",
+    }
+)
+
+# Transaction and certificate file names are the time this module was loaded
+# (formatted once), the process ID and a counter, so they are unique even for
+# names created within the same second or from several threads.
+_TX_NAME_STAMP = datetime.now().strftime("%Y-%m-%d_%Hh%Mm%Ss")
+_TX_NAME_COUNTER = itertools.count()
+
+
+def _tx_name(prefix):
+    return f"{prefix}_{_TX_NAME_STAMP}_{os.getpid()}_{next(_TX_NAME_COUNTER)}"
+
+
+# The cardano-cli host argument for each relay "host-type". See
+# ShelleyTools.generate_stake_pool_cert.
+_RELAY_HOST_ARGS = {
+    "ipv4": "--pool-relay-ipv4",
+    "ipv6": "--pool-relay-ipv6",
+    "single": "--single-host-pool-relay",
+    "multi": "--multi-host-pool-relay",
+}
+
+
+def _relay_args(pool_relays) -> str:
+    """Return the relay arguments of a pool certificate for a list of relay
+    dicts ("host-type", "host" and, except for multi-host relays, "port").
+    Relays of an unknown host type are skipped.
+    """
+    parts = []
+    for relay in pool_relays or []:
+        host_arg = next(
+            (
+                arg
+                for host_type, arg in _RELAY_HOST_ARGS.items()
+                if host_type in relay["host-type"]
+            ),
+            None,
+        )
+        if host_arg is None:
+            continue
+        parts.append(f"{host_arg} {relay['host']}")
+        if host_arg != "--multi-host-pool-relay":
+            parts.append(f"--pool-relay-port {relay['port']}")
+    return " ".join(parts)
+
+
+# Approximate serialized sizes (bytes) of the parts of a transaction. These are
+# only used to estimate fees while selecting UTXOs, the exact fee is always
+# computed by cardano-cli once the inputs are chosen.
+TX_BASE_SIZE = 50
+TX_IN_SIZE = 40
+TX_OUT_SIZE = 65
+TX_WITNESS_SIZE = 103
+
+
+def _estimate_tx_size(tx_in_count, tx_out_count, witness_count, extra_bytes=0):
+    return (
+        TX_BASE_SIZE
+        + TX_IN_SIZE * tx_in_count
+        + TX_OUT_SIZE * tx_out_count
+        + TX_WITNESS_SIZE * witness_count
+        + extra_bytes
+    )
+
+
+# Local JSON files larger than this (bytes) are parsed from a memory map.
+MMAP_MIN_SIZE = 64 * 1024
+
+# Maximum number of UTXOs spent by one transaction. The protocol's maximum
+# transaction size usually allows fewer.
+MAX_UTXOS_PER_TX = 3000
+
+# Maximum number of cardano-cli processes run at once on the local host.
+MAX_PARALLEL_CLI = 8
+
+# Maximum number of branches visited by the branch and bound UTXO selection.
+BNB_MAX_TRIES = 100_000
+
+
+def _select_utxos(utxos, target, fee_per_input, cost_of_change):
+    """Branch and bound search (as in Bitcoin Core) for a set of UTXOs that
+    covers a transaction without needing a change output.
+
+    Parameters
+    ----------
+    utxos : list
+        UTXOs sorted in descending order by value.
+    target : int
+        Lovelaces needed to pay the outputs and the fee without any inputs.
+    fee_per_input : int
+        Fee for adding one input to the transaction.
+    cost_of_change : int
+        Largest excess over the target that is worth paying as extra fee
+        rather than adding a change output.
+
+    Returns
+    -------
+    list
+        The selected UTXOs, or None if no selection was found.
+    """
+    # Spending a UTXO is only worth its value less the fee for the input.
+    pool = []
+    for utxo in utxos:
+        value = utxo["Lovelace"] - fee_per_input
+        if value > 0:
+            pool.append((value, utxo))
+    curr_available = sum(value for value, _ in pool)
+    if curr_available < target:
+        return None
+
+    best = None
+    best_excess = cost_of_change + 1
+    curr_selection = []  # indices in the pool
+    curr_value = 0
+    idx = 0
+    for _ in range(BNB_MAX_TRIES):
+        backtrack = False
+        if (
+            curr_value + curr_available < target
+            or curr_value > target + cost_of_change
+        ):
+            backtrack = True
+        elif curr_value >= target:
+            if curr_value - target < best_excess:
+                best = list(curr_selection)
+                best_excess = curr_value - target
+                if best_excess == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            if not curr_selection:
+                break  # The whole tree has been searched.
+
+            # Add the omitted UTXOs back before trying the branch without the
+            # last included one.
+            idx -= 1
+            while idx > curr_selection[-1]:
+                curr_available += pool[idx][0]
+                idx -= 1
+            curr_value -= pool[idx][0]
+            curr_selection.pop()
+        else:
+            value = pool[idx][0]
+            curr_available -= value
+
+            # Including this UTXO after omitting one of the same value would
+            # only repeat a branch that has been searched.
+            if not (
+                curr_selection
+                and curr_selection[-1] != idx - 1
+                and pool[idx - 1][0] == value
+            ):
+                curr_selection.append(idx)
+                curr_value += value
+        idx += 1
+
+    if best is None:
+        return None
+    return [pool[i][1] for i in best]
+
+
+def _drop_dust(utxos, fee_per_input):
+    """Return the UTXOs worth more than the fee for spending them."""
+    return [utxo for utxo in utxos if utxo["Lovelace"] > fee_per_input]
+
+
+def _change_arg(addr, amount) -> str:
+    """Return the build-raw argument paying `amount` lovelaces of change to
+    `addr`, or nothing when there is no change to pay.
+    """
+    if amount == 0:
+        return ""
+    return f"--tx-out {addr}+{amount} "
+
+
+def _split_args(cmd) -> list:
+    """Return a command given as a shell command as a list of arguments."""
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return list(cmd)
+
+
+def _join_args(cmd) -> str:
+    """Return a command given as a list of arguments as a shell command."""
+    if isinstance(cmd, str):
+        return cmd
+    return " ".join(shlex.quote(str(arg)) for arg in cmd)
+
+
+def _json_loads(data):
+    """Parse JSON from a str or bytes object."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj) -> str:
+    """Serialize an object to a compact JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    # Match the output of orjson so the bytes written (and their hashes) do
+    # not depend on whether it is installed.
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def _blake2b_256(data) -> str:
+    """Hash bytes the way cardano-cli hashes pool metadata files."""
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _log_cleanup_error(future):
+    """Log the error of a background file deletion, if it failed."""
+    error = future.exception()
+    if error is not None:
+        logger.error("Unable to delete temporary file: %s", error)
+
+
+def _ssh_pool_key(conn):
+    # connect_kwargs may hold unhashable values (e.g. a list of key files).
+    kwargs = conn.connect_kwargs.items()
+    kwargs = tuple(sorted((k, repr(v)) for k, v in kwargs))
+    return (conn.host, conn.user, conn.port, kwargs)
+
+
+def _reap_idle_ssh():
+    """Close pooled connections that have not been used for a while. They
+    are reopened on demand the next time they are used.
+    """
+    while True:
+        time.sleep(60)
+        now = time.monotonic()
+        with _SSH_POOL_LOCK:
+            for key, conn in _SSH_POOL.items():
+                idle = now - _SSH_POOL_LAST_USED.get(key, now)
+                if idle > _SSH_POOL_IDLE_TIMEOUT and conn.is_connected:
+                    with _SSH_POOL_CONN_LOCKS[key]:
+                        conn.close()
+
+
+def _release_ssh(key):
+    """Return True if the pooled connection `key` has no users left after
+    releasing one.
+    """
+    with _SSH_POOL_LOCK:
+        users = _SSH_POOL_USERS.get(key, 0) - 1
+        if users > 0:
+            _SSH_POOL_USERS[key] = users
+            return False
+        _SSH_POOL_USERS.pop(key, None)
+        return True
+
+
+def _get_ssh(conn):
+    """Return the pooled connection matching the parameters of `conn` and
+    its pool key. `conn` itself is added to the pool if there is none yet.
+    """
+    global _SSH_POOL_REAPER
+    key = _ssh_pool_key(conn)
+    with _SSH_POOL_LOCK:
+        conn = _SSH_POOL.setdefault(key, conn)
+        _SSH_POOL_CONN_LOCKS.setdefault(key, threading.Lock())
+        _SSH_POOL_USERS[key] = _SSH_POOL_USERS.get(key, 0) + 1
+        _SSH_POOL_LAST_USED[key] = time.monotonic()
+        if _SSH_POOL_REAPER is None:
+            _SSH_POOL_REAPER = threading.Thread(
+                target=_reap_idle_ssh, name="ssh-pool-reaper", daemon=True
+            )
+            _SSH_POOL_REAPER.start()
+    return conn, key
+
 
 class ShelleyError(Exception):
     pass
@@ -36,10 +369,27 @@ class ShelleyTools:
         # Set this first because its used during setup.
         self.socket = path_to_socket
 
+        # Take the SSH connection from the process-wide pool, open it once and
+        # keep it open. The socket path is exported through the command
+        # environment instead of being prepended to every command.
+        if self.ssh is not None:
+            self.ssh, self._ssh_key = _get_ssh(self.ssh)
+            self._ssh_lock = _SSH_POOL_CONN_LOCKS[self._ssh_key]
+            self._ssh_released = False
+            self.ssh.inline_ssh_env = True
+            self._ssh_env = {"CARDANO_NODE_SOCKET_PATH": self.socket}
+            self._reopen_if_dead()
+
+        # Locally, the socket path is passed through the environment of each
+        # CLI process. Build that environment once.
+        self._env = dict(os.environ, CARDANO_NODE_SOCKET_PATH=self.socket)
+
         # Set the path to the CLI and verify it works. An exception will be
-        # thrown if the command is not found.
+        # thrown if the command is not found. The CLI command is split into
+        # arguments once so that argument lists can be built from it.
         self.cli = path_to_cli
-        self.run_cli(f"{self.cli} --version")
+        self._cli_argv = shlex.split(str(self.cli))
+        self.run_cli(self._cli_args("--version"))
 
         # Set the working directory and make sure it exists.
         self.working_dir = Path(working_dir)
@@ -48,173 +398,494 @@ class ShelleyTools:
         else:
             self.run_cli(f'mkdir -p "{self.working_dir}"')
 
+        # Directories that are known to exist, so they are only created once.
+        self._ensured_dirs = {str(self.working_dir)}
+
         self.ttl_buffer = ttl_buffer
         self.network = network
         self.era = era
         self.protocol_parameters = None
 
-    def run_cli(self, cmd):
-        if self.ssh is not None:
+        # The protocol parameters and the tip are cached for a short time
+        # (seconds) so that repeated queries while building a transaction do
+        # not each go to the node. Transaction TTLs (see `get_ttl`) accept an
+        # older tip.
+        self.protocol_parameters_ttl = 20
+        self.tip_ttl = 1
+        self._params_loaded_at = None
+        self._params_text = None
+        self._params_file_written = False
+        self._params_lock = threading.RLock()
+        self._tip = None
+        self._tip_queried_at = None
+        self._tip_lock = threading.Lock()
+
+        # Corrections (bytes) to the estimated transaction size, learnt from
+        # the exact fees calculated while selecting UTXOs. They are kept per
+        # transaction shape (output count, witness count, extra bytes) since
+        # e.g. withdrawals are not part of the estimate; shapes that have not
+        # been calibrated yet use the last correction of any shape.
+        self._fee_size_offset = 0
+        self._fee_size_offsets = {}
+        self._fee_lock = threading.Lock()
+
+        # Results of lookups that only depend on the contents of a key file
+        # (key hashes, pool IDs) keyed by the lookup and the file contents.
+        self._key_lookup_cache = {}
+
+        # Parsed genesis files keyed by path, with the modification time they
+        # were parsed at (None for remote files, which do not change while a
+        # node is running).
+        self._genesis_cache = {}
+
+        # HTTP session so that downloads reuse the TCP/TLS connection, and the
+        # (URL, destination path) pairs that have already been downloaded
+        # mapped to the ETag of the response, for the responses that had one.
+        self._http = requests.Session()
+        self._downloads = {}
+
+        # Temporary transaction files are deleted on a background thread so
+        # the methods return as soon as the transaction has been submitted.
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Finish deleting temporary files and release the SSH connection to
+        the remote host (if any). The pooled connection is closed once no
+        other object is using it (see also `close_pool`).
+        """
+        self._cleanup_executor.shutdown(wait=True)
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=1)
+        if self.ssh is not None and not self._ssh_released:
+            self._ssh_released = True
+            if _release_ssh(self._ssh_key):
+                with self._ssh_lock:
+                    self.ssh.close()
+
+    @staticmethod
+    def close_pool():
+        """Close and forget every pooled SSH connection."""
+        with _SSH_POOL_LOCK:
+            for key, conn in _SSH_POOL.items():
+                with _SSH_POOL_CONN_LOCKS[key]:
+                    conn.close()
+            _SSH_POOL.clear()
+            _SSH_POOL_LAST_USED.clear()
+            _SSH_POOL_USERS.clear()
+
+    def _reopen_if_dead(self):
+        """Reconnect to the remote host if the connection has dropped. Only
+        one thread reconnects, and a live connection is never closed, so the
+        commands other threads are running on it are not interrupted.
+        """
+        if self.ssh.is_connected:
+            return
+        with self._ssh_lock:
+            if not self.ssh.is_connected:
+                self.ssh.close()
+                self.ssh.open()
+
+    def _ssh_run(self, cmd, retry=False, **kwargs):
+        """Run a command on the persistent SSH connection. If the connection
+        fails, the command is only run again if `retry` is set, since it may
+        already have run (e.g. submitted a transaction or generated keys).
+        """
+        _SSH_POOL_LAST_USED[self._ssh_key] = time.monotonic()
+        kwargs.setdefault("env", self._ssh_env)
+        self._reopen_if_dead()
+        try:
+            return self.ssh.run(cmd, **kwargs)
+        except SSHException:
+            # Reconnect if the transport died so later commands work.
+            self._reopen_if_dead()
+            if not retry:
+                raise
+            return self.ssh.run(cmd, **kwargs)
+
+    def _cli_args(self, *args):
+        """Return the argument list running cardano-cli with `args`."""
+        return [*self._cli_argv, *args]
+
+    def run_cli(self, cmd, retry=False):
+        """Run a command locally or on the remote host.
 
-            self.ssh.open()  # Open the connection
+        Parameters
+        ----------
+        cmd : str or list
+            The command string, or a list of the command's arguments. Argument
+            lists are run locally as is, without being tokenized again.
+        retry : bool, optional
+            Run the command again if the SSH connection fails while running
+            it. Only set this for commands that change nothing, e.g. queries
+            (defaults to False).
+
+        Returns
+        -------
+        CliResult
+            The stripped stdout and stderr and the return code.
+        """
+        if self.ssh is not None:
 
             # Run the commands remotely
-            cmd = f"export CARDANO_NODE_SOCKET_PATH={self.socket}; " + cmd
+            cmd = _join_args(cmd)
             if self.debug:
                 print(f'CMD: "{cmd}"')
-                result = self.ssh.run(cmd, warn=True)
+                result = self._ssh_run(cmd, retry, warn=True)
                 print(f'stdout: "{result.stdout}"')
                 print(f'stderr: "{result.stderr}"')
             else:
-                result = self.ssh.run(cmd, warn=True, hide=True)
+                result = self._ssh_run(cmd, retry, warn=True, hide=True)
             stdout = result.stdout.strip()
             stderr = result.stderr.strip()
-
-            self.ssh.close()  # Close the connection
+            returncode = result.return_code
 
         else:
 
-            # Execute the commands locally
-            os.environ["CARDANO_NODE_SOCKET_PATH"] = self.socket
-            result = subprocess.run(shlex.split(cmd), capture_output=True)
+            # Execute the commands locally. Leaving the (non-inheritable) file
+            # descriptors open lets subprocess use posix_spawn.
+            argv = _split_args(cmd)
+            result = subprocess.run(
+                argv,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=False,
+                env=self._env,
+            )
             stdout = result.stdout.decode().strip()
             stderr = result.stderr.decode().strip()
+            returncode = result.returncode
             if self.debug:
                 print(f'CMD: "{cmd}"')
                 print(f'stdout: "{stdout}"')
                 print(f'stderr: "{stderr}"')
 
-        ResultType = namedtuple("Result", "stdout, stderr")
-        return ResultType(stdout, stderr)
+        return CliResult(stdout, stderr, returncode)
 
-    def _load_text_file(self, fpath):
+    def _run_cli_batch(self, cmds, parallel=()):
+        """Run a sequence of commands, stopping at the first one that fails.
+
+        On a remote host the commands are chained into a single shell command
+        so they all run over one SSH channel.
+
+        Parameters
+        ----------
+        cmds : list
+            The commands (strings or argument lists) to run in order.
+        parallel : list, optional
+            Independent commands to run concurrently before `cmds`.
+
+        Returns
+        -------
+        CliResult
+            The combined output of the commands that were run.
+        """
         if self.ssh is not None:
-            # Open the connection
-            self.ssh.open()
+            # Start the independent commands as background jobs and wait for
+            # each one to succeed before running the rest. The whole script
+            # runs in its own shell so the environment the connection exports
+            # in front of the command applies to every part of it.
+            jobs = [
+                f"{_join_args(cmd)} & pid{i}=$!"
+                for i, cmd in enumerate(parallel)
+            ]
+            waits = [f"wait $pid{i}" for i in range(len(parallel))]
+            cmds = [_join_args(cmd) for cmd in cmds]
+            script = "; ".join(jobs + [" && ".join(waits + cmds)])
+            return self.run_cli(_join_args(["sh", "-c", script]))
+
+        results = []
+        if parallel:
+            workers = min(MAX_PARALLEL_CLI, len(parallel))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results.extend(executor.map(self.run_cli, parallel))
+        if all(result.returncode == 0 for result in results):
+            for cmd in cmds:
+                results.append(self.run_cli(cmd))
+                if results[-1].returncode != 0:
+                    break
+
+        failed = [result for result in results if result.returncode != 0]
+        last = failed[0] if failed else results[-1]
+        stdout = "\n".join(result.stdout for result in results if result.stdout)
+        return CliResult(stdout, last.stderr, last.returncode)
+
+    def _ensure_folder(self, folder):
+        """Return the folder for generated files (defaults to the working
+        directory) as a Path, creating it if it has not been seen before.
+        """
+        if folder is None:
+            return self.working_dir
 
+        folder = Path(folder)
+        if str(folder) not in self._ensured_dirs:
+            if self.ssh is None:
+                folder.mkdir(parents=True, exist_ok=True)
+            else:
+                self.run_cli(f'mkdir -p "{folder}"')
+            self._ensured_dirs.add(str(folder))
+        return folder
+
+    def _load_text_file(self, fpath):
+        if self.ssh is not None:
             # Run the commands remotely
-            result = self.ssh.run(f"cat {fpath}", warn=True, hide=True)
+            cmd = f"cat {fpath}"
+            result = self._ssh_run(cmd, retry=True, warn=True, hide=True)
             text = result.stdout
 
-            # Close the connection
-            self.ssh.close()
-
         else:
-            text = open(fpath, "r").read()
+            with open(fpath, "r", encoding="utf-8") as infile:
+                text = infile.read()
 
         return text
 
+    def _load_genesis(self, genesis_file):
+        # A local file that was replaced since it was parsed is read again.
+        key = str(genesis_file)
+        mtime = None if self.ssh is not None else os.path.getmtime(key)
+        cached = self._genesis_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, self._load_json_file(genesis_file))
+            self._genesis_cache[key] = cached
+        return cached[1]
+
+    def _load_json_file(self, fpath):
+        if self.ssh is not None:
+            return _json_loads(self._load_text_file(fpath))
+
+        # Locally, parse straight from the file rather than reading it into a
+        # str first.
+        if orjson is None:
+            with open(fpath, "r", encoding="utf-8") as infile:
+                return json.load(infile)
+        with open(fpath, "rb") as infile:
+            # orjson can parse a memory map of a large file without copying
+            # it into a bytes object first.
+            if os.fstat(infile.fileno()).st_size > MMAP_MIN_SIZE:
+                with mmap.mmap(
+                    infile.fileno(), 0, access=mmap.ACCESS_READ
+                ) as mapped:
+                    return orjson.loads(memoryview(mapped))
+            return orjson.loads(infile.read())
+
     def _dump_text_file(self, fpath, datastr):
         if self.ssh is not None:
 
             # Run the commands remotely
-            self.ssh.open()  # Open the connection
             cmd = f'printf "%s" \'{datastr}\' > "{fpath}"'
-            self.ssh.run(cmd, warn=True, hide=True)
-            self.ssh.close()  # Close the connection
+            self._ssh_run(cmd, warn=True, hide=True)
 
         else:
-            with open(fpath, "w") as outfile:
-                outfile.write(datastr)
+            # Write UTF-8 bytes whatever the locale, so the file holds exactly
+            # the bytes that are hashed, e.g. for pool metadata.
+            with open(fpath, "wb") as outfile:
+                outfile.write(datastr.encode())
+
+    def _replace_file(self, src, dst):
+        """Atomically move the file `src` over the file `dst`."""
+        if self.ssh is not None:
+
+            # Run the commands remotely
+            cmd = f'mv -f "{src}" "{dst}"'
+            result = self._ssh_run(cmd, warn=True, hide=True)
+            if result.return_code != 0:
+                raise ShelleyError(result.stderr.strip())
+
+        else:
+            os.replace(src, dst)
 
     def _download_file(self, url, fpath):
+        # If this URL was already saved to the same file and the server sent an
+        # ETag, ask it whether the file has changed since. Otherwise the file
+        # is downloaded again, since it may have changed.
+        download_key = (url, str(fpath))
+        etag = self._downloads.pop(download_key, None)
+
         if self.ssh is not None:
 
             # Run the commands remotely
-            self.ssh.open()  # Open the connection
             cmd = f"curl -sSL {url} -o {fpath}"
-            self.ssh.run(cmd, warn=True, hide=True)
-            self.ssh.close()  # Close the connection
+            self._ssh_run(cmd, warn=True, hide=True)
 
         else:
-            download = requests.get(url)
-            with open(fpath, "wb") as download_file:
-                download_file.write(download.content)
+            # Stream the response straight to disk rather than buffering it.
+            # A file that is gone is downloaded in full.
+            if not os.path.exists(fpath):
+                etag = None
+            headers = {"If-None-Match": etag} if etag is not None else None
+            with self._http.get(url, headers=headers, stream=True) as download:
+                if download.status_code == 304:
+                    self._downloads[download_key] = etag  # Not modified
+                    return
+                download.raise_for_status()
+                download.raw.decode_content = True
+                with open(fpath, "wb") as download_file:
+                    shutil.copyfileobj(download.raw, download_file)
+                etag = download.headers.get("ETag")
+
+            if etag is not None:
+                self._downloads[download_key] = etag
 
     def _cleanup_file(self, fpath):
+        self._downloads = {
+            key: etag
+            for key, etag in self._downloads.items()
+            if key[1] != str(fpath)
+        }
+        future = self._cleanup_executor.submit(self._remove_file, fpath)
+        future.add_done_callback(_log_cleanup_error)
+
+    def _remove_file(self, fpath):
         if self.ssh is not None:
 
             # Run the commands remotely
-            self.ssh.open()  # Open the connection
-            self.ssh.run(f"rm {fpath}", warn=True, hide=True)
-            self.ssh.close()  # Close the connection
+            result = self._ssh_run(f"rm {fpath}", warn=True, hide=True)
+            if result.return_code != 0:
+                raise ShelleyError(result.stderr.strip())
 
         else:
-            os.remove(fpath)
+            os.unlink(fpath)
+
+    def _refresh_protocol_parameters(self):
+        """Query the protocol parameters into `protocol_parameters` unless the
+        cached copy is younger than `protocol_parameters_ttl` seconds.
+        """
+        with self._params_lock:
+            if (
+                self._params_loaded_at is not None
+                and time.monotonic() - self._params_loaded_at
+                < self.protocol_parameters_ttl
+            ):
+                return
+
+            # Parse the parameters straight from the CLI output. The file is
+            # only written when a cardano-cli command needs it.
+            network = self.network.split()
+            cmd = self._cli_args("query", "protocol-parameters", *network)
+            result = self.run_cli(cmd, retry=True)
+            self.protocol_parameters = _json_loads(result.stdout)
+            self._params_text = result.stdout
+            self._params_file_written = False
+            self._params_loaded_at = time.monotonic()
 
     def load_protocol_parameters(self):
         """Load the protocol parameters which are needed for creating
         transactions.
+
+        The parameters are only queried from the node again once they are
+        older than `protocol_parameters_ttl` seconds.
+
+        Returns
+        -------
+        Path
+            Path to the protocol parameters file.
         """
         params_file = self.working_dir / "protocol.json"
-        self.run_cli(
-            f"{self.cli} query protocol-parameters {self.network} "
-            f"--out-file {params_file}"
-        )
-        json_data = self._load_text_file(params_file)
-        self.protocol_parameters = json.loads(json_data)
+        with self._params_lock:
+            self._refresh_protocol_parameters()
+            if not self._params_file_written:
+                # Other threads may be reading the file, so the new one is
+                # written next to it and moved into place.
+                tmp_file = self.working_dir / "protocol.json.tmp"
+                self._dump_text_file(tmp_file, self._params_text)
+                self._replace_file(tmp_file, params_file)
+                self._params_file_written = True
         return params_file
 
-    def get_tip(self) -> int:
+    def invalidate_protocol_parameters(self):
+        """Force the protocol parameters to be queried again on next use, e.g.
+        at an epoch boundary.
+        """
+        self._params_loaded_at = None
+
+    def get_tip(self, max_age=None) -> int:
         """Query the node for the current tip of the blockchain.
+
+        The tip is only queried from the node again once it is older than
+        `tip_ttl` seconds.
+
+        Parameters
+        ----------
+        max_age : float, optional
+            Oldest cached tip (seconds) to accept instead of `tip_ttl`. Pass 0
+            to always query the node.
         """
-        cmd = f"{self.cli} query tip {self.network}"
-        result = self.run_cli(cmd)
-        if "slot" not in result.stdout:
-            raise ShelleyError(result.stderr)
-        vals = json.loads(result.stdout)
-        return vals["slot"]
+        if max_age is None:
+            max_age = self.tip_ttl
+
+        # Threads sending transactions concurrently wait for a single query
+        # rather than each querying the node.
+        with self._tip_lock:
+            if (
+                self._tip_queried_at is not None
+                and time.monotonic() - self._tip_queried_at < max_age
+            ):
+                return self._tip
+
+            cmd = self._cli_args("query", "tip", *self.network.split())
+            result = self.run_cli(cmd, retry=True)
+            match = _SLOT_RE.search(result.stdout)
+            if match is None:
+                raise ShelleyError(result.stderr)
+            self._tip = int(match.group(1))
+            self._tip_queried_at = time.monotonic()
+            return self._tip
+
+    def get_ttl(self) -> int:
+        """Return the slot after which a transaction built now is invalid,
+        `ttl_buffer` slots after the tip.
+
+        The tip used may be up to half of the buffer old (a slot is a second),
+        so the transaction is still valid for at least half of the buffer.
+        """
+        return self.get_tip(max_age=self.ttl_buffer // 2) + self.ttl_buffer
 
     def make_address(self, name, folder=None) -> str:
         """Create an address and the corresponding payment and staking keys.
         """
-        if folder is None:
-            folder = self.working_dir
-
-        folder = Path(folder)
-        if self.ssh is None:
-            folder.mkdir(parents=True, exist_ok=True)
-        else:
-            self.run_cli(f'mkdir -p "{folder}"')
-        payment_vkey = folder / (name + ".vkey")
-        payment_skey = folder / (name + ".skey")
-        stake_vkey = folder / (name + "_stake.vkey")
-        stake_skey = folder / (name + "_stake.skey")
-        payment_addr = folder / (name + ".addr")
-        stake_addr = folder / (name + "_stake.addr")
-
-        # Generate payment key pair.
-        self.run_cli(
+        folder = self._ensure_folder(folder)
+
+        # The paths are only used in the CLI commands so build them as strings.
+        prefix = f"{folder}/{name}"
+        payment_vkey = f"{prefix}.vkey"
+        payment_skey = f"{prefix}.skey"
+        stake_vkey = f"{prefix}_stake.vkey"
+        stake_skey = f"{prefix}_stake.skey"
+        payment_addr = f"{prefix}.addr"
+        stake_addr = f"{prefix}_stake.addr"
+
+        # Generate the payment and stake key pairs and build both addresses
+        # in a single batch of commands. On a remote host the payment address
+        # is read back in the same batch.
+        cmds = [
             f"{self.cli} address key-gen "
             f"--verification-key-file {payment_vkey} "
-            f"--signing-key-file {payment_skey}"
-        )
-
-        # Generate stake key pair.
-        self.run_cli(
+            f"--signing-key-file {payment_skey}",
             f"{self.cli} stake-address key-gen "
             f"--verification-key-file {stake_vkey} "
-            f"--signing-key-file {stake_skey}"
-        )
-
-        # Create the payment address.
-        self.run_cli(
+            f"--signing-key-file {stake_skey}",
             f"{self.cli} address build "
             f"--payment-verification-key-file {payment_vkey} "
             f"--stake-verification-key-file {stake_vkey} "
-            f"--out-file {payment_addr} {self.network}"
-        )
-
-        # Create the staking address.
-        self.run_cli(
+            f"--out-file {payment_addr} {self.network}",
             f"{self.cli} stake-address build "
             f"--stake-verification-key-file {stake_vkey} "
-            f"--out-file {stake_addr} {self.network}"
-        )
+            f"--out-file {stake_addr} {self.network}",
+        ]
+        if self.ssh is not None:
+            cmds.append(f"cat {payment_addr}")
+        result = self._run_cli_batch(cmds)
+        if result.returncode != 0:
+            raise ShelleyError(f"Unable to create address: {result.stderr}")
 
-        # Read the file and return the payment address.
-        addr = self._load_text_file(payment_addr).strip()
-        return addr
+        # Remotely, the payment address is the output of the last command.
+        if self.ssh is not None:
+            return result.stdout.splitlines()[-1].strip()
+        return self._load_text_file(payment_addr).strip()
 
     def get_key_hash(self, vkey_path) -> str:
         """Generate a public key hash from a verification key file.
@@ -229,11 +900,44 @@ class ShelleyTools:
         str
             The key hash.
         """
-        result = self.run_cli(
+        # The key hash is the blake2b-224 digest of the key bytes, so it is
+        # computed in-process when the file is a payment or stake verification
+        # key holding a plain CBOR byte string. Anything else (e.g. a bech32,
+        # raw or other key type) is left to cardano-cli.
+        try:
+            envelope = self._load_json_file(vkey_path)
+            known_type = envelope.get("type") in _KEY_HASH_VKEY_TYPES
+            key_cbor = bytes.fromhex(envelope.get("cborHex", ""))
+        except (ValueError, AttributeError, TypeError):
+            known_type, key_cbor = False, b""
+        if (
+            known_type
+            and len(key_cbor) > 2
+            and key_cbor[0] == 0x58
+            and key_cbor[1] in (32, 64)
+            and len(key_cbor) == 2 + key_cbor[1]
+        ):
+            key = key_cbor[2:34]  # Extended keys also hold a chain code
+            return hashlib.blake2b(key, digest_size=28).hexdigest()
+
+        return self._cached_key_lookup(
             f"{self.cli} address key-hash "
-            f"--payment-verification-key-file {vkey_path}"
+            f"--payment-verification-key-file {vkey_path}",
+            "key-hash",
+            vkey_path,
         )
-        return result.stdout
+
+    def _cached_key_lookup(self, cmd, lookup, key_file) -> str:
+        """Run a CLI command whose output only depends on the contents of a
+        key file. The output is reused for as long as the file is unchanged.
+        """
+        cache_key = (lookup, self._load_text_file(key_file))
+        if cache_key not in self._key_lookup_cache:
+            result = self.run_cli(cmd)
+            if result.returncode != 0:
+                return result.stdout
+            self._key_lookup_cache[cache_key] = result.stdout
+        return self._key_lookup_cache[cache_key]
 
     def get_utxos(self, addr, filter=None) -> list:
         """Query the list of UTXOs for a given address and parse the output.
@@ -250,62 +954,50 @@ class ShelleyTools:
         Returns
         -------
         list
-            List of UTXOs parsed into dictionary objects.
+            List of UTXOs parsed into dictionary objects. The "Lovelace" and
+            token amounts are ints.
         """
 
         # Query the UTXOs for the given address (this will not get everything
         # for a given wallet that contains multiple addresses.)
+        network = self.network.split()
         result = self.run_cli(
-            f"{self.cli} query utxo --address {addr} {self.network}"
+            self._cli_args("query", "utxo", "--address", addr, *network),
+            retry=True,
         )
-        raw_utxos = result.stdout.split("\n")[2:]
 
-        # Parse the UTXOs into a list of dict objects
+        # Parse the UTXOs into a list of dict objects, skipping the ones that
+        # do not match the filter. Extra tokens are separated by a "+" sign;
+        # parsing stops at the first "+" that is not followed by an amount and
+        # a token (e.g. an Alonzo datum hash).
         utxos = []
-        for utxo_line in raw_utxos:
-            vals = utxo_line.split()
+        for line in _UTXO_LINE_RE.finditer(result.stdout):
+            tx_hash, tx_ix, lovelace, extra = line.groups()
+            assets = _ASSET_RE.findall(_ASSETS_RE.match(extra).group())
+
+            if filter == "Lovelace":
+                if assets:
+                    continue
+            elif filter is not None:
+                if all(asset != filter for _, asset in assets):
+                    continue
+
             utxo_dict = {
-                "TxHash": vals[0],
-                "TxIx": vals[1],
-                "Lovelace": vals[2],
+                "TxHash": tx_hash,
+                "TxIx": tx_ix,
+                "Lovelace": int(lovelace),
             }
-
-            # Extra tokens will be separated by a "+" sign.
-            extra = [i for i, j in enumerate(vals) if j == "+"]
-            for i in extra:
-                try:
-                    asset = vals[i + 2]
-                    amt = vals[i + 1]
-                    if asset in utxo_dict:
-                        utxo_dict[asset] += amt
-                    else:
-                        utxo_dict[asset] = amt
-                except:
-                    print("skipping alonzo extra datum")
-                
+            for amt, asset in assets:
+                utxo_dict[asset] = utxo_dict.get(asset, 0) + int(amt)
             utxos.append(utxo_dict)
 
-        # Filter utxos
-        if filter is not None:
-            if filter == "Lovelace":
-                utxos = [
-                    utxo
-                    for utxo in utxos
-                    if filter in utxo and len(utxo.keys()) == 3
-                ]
-            else:
-                utxos = [utxo for utxo in utxos if filter in utxo]
-
         return utxos
 
     def query_balance(self, addr) -> int:
         """Query an address balance in lovelace.
         """
-        total = 0
         utxos = self.get_utxos(addr)
-        for utxo in utxos:
-            total += int(utxo["Lovelace"])
-        return total
+        return sum(utxo["Lovelace"] for utxo in utxos)
 
     def calc_min_fee(
         self,
@@ -314,6 +1006,7 @@ class ShelleyTools:
         tx_out_count,
         witness_count,
         byron_witness_count=0,
+        protocol_params_file=None,
     ) -> int:
         """Calculate the minimum fee in lovelaces for the transaction.
 
@@ -329,25 +1022,305 @@ class ShelleyTools:
             The number of transaction signing keys.
         byron_witness_count : int, optional
             Number of Byron witnesses (defaults to 0).
+        protocol_params_file : str or Path, optional
+            Protocol parameters file returned by `load_protocol_parameters`.
+            Passing it lets a loop calculating several fees reuse the same
+            parameters (defaults to loading them).
         
         Returns
         -------
         int
             The minimum fee in lovelaces.
         """
-        params_file = self.load_protocol_parameters()
-        result = self.run_cli(
-            f"{self.cli} transaction calculate-min-fee "
-            f"--tx-body-file {tx_draft} "
-            f"--tx-in-count {tx_in_count} "
-            f"--tx-out-count {tx_out_count} "
-            f"--witness-count {witness_count} "
-            f"--byron-witness-count {byron_witness_count} "
-            f"{self.network} --protocol-params-file {params_file}"
+        cmd = self._min_fee_args(
+            tx_draft,
+            tx_in_count,
+            tx_out_count,
+            witness_count,
+            byron_witness_count,
+            protocol_params_file,
         )
+        result = self.run_cli(cmd)
         min_fee = int(result.stdout.split()[0])
         return min_fee
 
+    def _min_fee_args(
+        self,
+        tx_draft,
+        tx_in_count,
+        tx_out_count,
+        witness_count,
+        byron_witness_count=0,
+        protocol_params_file=None,
+    ) -> list:
+        """Return the "calculate-min-fee" command as a list of arguments."""
+        params_file = protocol_params_file
+        if params_file is None:
+            params_file = self.load_protocol_parameters()
+        return self._cli_args(
+            "transaction",
+            "calculate-min-fee",
+            "--tx-body-file",
+            str(tx_draft),
+            "--tx-in-count",
+            str(tx_in_count),
+            "--tx-out-count",
+            str(tx_out_count),
+            "--witness-count",
+            str(witness_count),
+            "--byron-witness-count",
+            str(byron_witness_count),
+            *self.network.split(),
+            "--protocol-params-file",
+            str(params_file),
+        )
+
+    def _draft_min_fee(
+        self,
+        draft_cmd,
+        tx_draft,
+        tx_in_count,
+        tx_out_count,
+        witness_count,
+        protocol_params_file=None,
+    ) -> int:
+        """Build a draft transaction and calculate its minimum fee. On a
+        remote host both commands are run over a single SSH channel.
+        """
+        min_fee_cmd = self._min_fee_args(
+            tx_draft,
+            tx_in_count,
+            tx_out_count,
+            witness_count,
+            protocol_params_file=protocol_params_file,
+        )
+        result = self._run_cli_batch([draft_cmd, min_fee_cmd])
+        if result.returncode != 0:
+            raise ShelleyError(
+                f"Unable to calculate the minimum fee: {result.stderr}"
+            )
+
+        # The fee is the output of the last command.
+        return int(result.stdout.splitlines()[-1].split()[0])
+
+    def estimate_min_fee(
+        self, tx_in_count, tx_out_count, witness_count, extra_bytes=0
+    ) -> int:
+        """Estimate the minimum fee in lovelaces for a transaction from the
+        linear fee parameters, without calling cardano-cli. Until it has been
+        calibrated with `calibrate_fee_estimate` the estimate errs on the
+        high side.
+
+        Parameters
+        ----------
+        tx_in_count : int
+            The number of UTXOs being spent.
+        tx_out_count : int
+            The number of output UTXOs.
+        witness_count : int
+            The number of transaction signing keys.
+        extra_bytes : int, optional
+            Size of anything else in the transaction (e.g. certificates).
+
+        Returns
+        -------
+        int
+            The estimated minimum fee in lovelaces.
+        """
+        self._refresh_protocol_parameters()
+        with self._fee_lock:
+            offset = self._fee_size_offsets.get(
+                (tx_out_count, witness_count, extra_bytes),
+                self._fee_size_offset,
+            )
+        size = offset + _estimate_tx_size(
+            tx_in_count, tx_out_count, witness_count, extra_bytes
+        )
+        fee_fixed = self.protocol_parameters["txFeeFixed"]
+        fee_per_byte = self.protocol_parameters["txFeePerByte"]
+        return fee_fixed + fee_per_byte * size
+
+    def calibrate_fee_estimate(
+        self, min_fee, tx_in_count, tx_out_count, witness_count, extra_bytes=0
+    ):
+        """Correct `estimate_min_fee` using the exact fee calculated by
+        cardano-cli for a transaction of the given shape. The difference in
+        size is kept as a correction for later estimates of that shape, and of
+        shapes that have not been calibrated yet.
+
+        Parameters
+        ----------
+        min_fee : int
+            The minimum fee calculated by cardano-cli (e.g. with
+            `calc_min_fee`) for a draft of the transaction.
+        tx_in_count : int
+            The number of UTXOs spent by the draft.
+        tx_out_count : int
+            The number of output UTXOs.
+        witness_count : int
+            The number of transaction signing keys.
+        extra_bytes : int, optional
+            Size of anything else in the transaction (e.g. certificates).
+        """
+        self._refresh_protocol_parameters()
+        fee_fixed = self.protocol_parameters["txFeeFixed"]
+        fee_per_byte = self.protocol_parameters["txFeePerByte"]
+        if fee_per_byte <= 0:
+            return
+        size = -(-(min_fee - fee_fixed) // fee_per_byte)  # Round up
+        offset = size - _estimate_tx_size(
+            tx_in_count, tx_out_count, witness_count, extra_bytes
+        )
+        shape = (tx_out_count, witness_count, extra_bytes)
+        with self._fee_lock:
+            self._fee_size_offset = offset
+            self._fee_size_offsets[shape] = offset
+
+    def _max_tx_inputs(
+        self, tx_out_count, witness_count, extra_bytes=0
+    ) -> int:
+        """Return the (estimated) largest number of inputs that fits in a
+        transaction of the given shape, at most `MAX_UTXOS_PER_TX`.
+        """
+        self._refresh_protocol_parameters()
+        max_size = self.protocol_parameters.get("maxTxSize")
+        if max_size is None:
+            return MAX_UTXOS_PER_TX
+        spare = max_size - _estimate_tx_size(
+            0, tx_out_count, witness_count, extra_bytes
+        )
+        return max(1, min(MAX_UTXOS_PER_TX, spare // TX_IN_SIZE))
+
+    def _cert_size(self, cert_file) -> int:
+        """Return the size in bytes of the certificate in a (text envelope)
+        certificate file.
+        """
+        envelope = self._load_json_file(cert_file)
+        return len(envelope["cborHex"]) // 2
+
+    def _select_fee_inputs(
+        self,
+        utxos,
+        draft_cmd,
+        draft_args,
+        tx_draft_file,
+        tx_out_count,
+        witness_count,
+        extra_bytes=0,
+        required=0,
+        params_file=None,
+    ):
+        """Find the fewest of the UTXOs (sorted in decending order by value)
+        that pay for a transaction.
+
+        The count is estimated with the linear fee formula and a draft
+        spending that many UTXOs is built to get the exact fee. cardano-cli
+        computes the fee from the inputs in the draft body, so a draft is
+        needed for each count that is tried. If the estimate was too low, it
+        is calibrated with the exact fee of that draft and the search skips
+        straight to the count it then calls for, so this usually takes one
+        draft.
+
+        UTXOs worth less than the fee for spending them are never selected,
+        and no more UTXOs than fit in the transaction.
+
+        Parameters
+        ----------
+        utxos : list
+            UTXOs sorted in decending order by value.
+        draft_cmd : str or list
+            The draft command up to the transaction inputs.
+        draft_args : str or list
+            The rest of the draft command, writing it to `tx_draft_file`.
+        tx_draft_file : str or Path
+            Path to the draft transaction file.
+        tx_out_count : int
+            The number of output UTXOs.
+        witness_count : int
+            The number of transaction signing keys.
+        extra_bytes : int, optional
+            Size of anything else in the transaction (e.g. certificates).
+        required : int, optional
+            Lovelaces needed besides the fee (e.g. deposits).
+        params_file : str or Path, optional
+            Protocol parameters file returned by `load_protocol_parameters`.
+
+        Returns
+        -------
+        (int, int, int, str)
+            The number of UTXOs spent, their total value, the minimum fee and
+            the transaction input arguments. If no count covers the
+            transaction, these are for spending all of the UTXOs.
+
+        Raises
+        ------
+        ShelleyError
+            If there are no UTXOs worth spending.
+        """
+        self._refresh_protocol_parameters()
+        fee_per_byte = self.protocol_parameters["txFeePerByte"]
+        utxos = _drop_dust(utxos, TX_IN_SIZE * fee_per_byte)
+        utxos = utxos[: self._max_tx_inputs(
+            tx_out_count, witness_count, extra_bytes
+        )]
+        if not utxos:
+            cost = self.estimate_min_fee(
+                1, tx_out_count, witness_count, extra_bytes
+            )
+            cost_ada = (cost + required) / 1_000_000
+            raise ShelleyError(
+                f"Transaction failed due to insufficient funds. The account "
+                f"has no UTXOs worth spending to pay transaction costs of "
+                f"about {cost_ada} ADA."
+            )
+
+        utxo_totals = list(
+            itertools.accumulate(utxo["Lovelace"] for utxo in utxos)
+        )
+        tx_in_args = [
+            f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}" for utxo in utxos
+        ]
+
+        # The drafts are run as argument lists so that the (possibly long)
+        # input list is not tokenized again for every draft.
+        draft_head = _split_args(draft_cmd)
+        draft_tail = _split_args(draft_args)
+        tx_in_argv = [
+            arg
+            for utxo in utxos
+            for arg in ("--tx-in", f"{utxo['TxHash']}#{utxo['TxIx']}")
+        ]
+        first_count = 1
+        while True:
+            utxo_count = len(utxos)
+            for idx in range(first_count - 1, len(utxos)):
+                est_fee = self.estimate_min_fee(
+                    idx + 1, tx_out_count, witness_count, extra_bytes
+                )
+                if utxo_totals[idx] > est_fee + required:
+                    utxo_count = idx + 1
+                    break
+            utxo_total = utxo_totals[utxo_count - 1]
+            tx_in_str = "".join(tx_in_args[:utxo_count])
+
+            # Build a transaction draft and calculate the minimum fee.
+            min_fee = self._draft_min_fee(
+                draft_head + tx_in_argv[: 2 * utxo_count] + draft_tail,
+                tx_draft_file,
+                utxo_count,
+                tx_out_count=tx_out_count,
+                witness_count=witness_count,
+                protocol_params_file=params_file,
+            )
+            self.calibrate_fee_estimate(
+                min_fee, utxo_count, tx_out_count, witness_count, extra_bytes
+            )
+
+            covered = utxo_total > min_fee + required
+            if covered or utxo_count == len(utxos):
+                return (utxo_count, utxo_total, min_fee, tx_in_str)
+            first_count = utxo_count + 1
+
     def send_payment(
         self, amt, to_addr, from_addr, key_file, offline=False, cleanup=True
     ):
@@ -371,14 +1344,104 @@ class ShelleyTools:
             Flag that indicates if the temporary transaction files should be
             removed when finished (defaults to True).
         """
-        payment = amt * 1_000_000  # ADA to Lovelaces
+        # ADA to Lovelaces, rounded since the CLI only takes whole Lovelaces.
+        payment = round(amt * 1_000_000)
+        self._send_lovelaces(
+            [to_addr], [payment], from_addr, key_file, offline, cleanup
+        )
+
+    def send_payments_bulk(self, transfers, offline=False, cleanup=True):
+        """Send several payments. The payments sent from the same address are
+        combined into a single transaction, so the UTXOs are queried and the
+        fee is calculated, signed and submitted once per sending address. The
+        transactions for different sending addresses are sent concurrently.
+
+        Parameters
+        ----------
+        transfers : list
+            List of (amt, to_addr, from_addr, key_file) tuples with the same
+            meaning as the arguments of `send_payment`. The number of payments
+            from one address is limited by the maximum transaction size.
+        offline: bool, optional
+            Flag to indicate if the transactions are being generated offline.
+            If true (defaults to false), the transaction files are signed but
+            not sent.
+        cleanup : bool, optional
+            Flag that indicates if the temporary transaction files should be
+            removed when finished (defaults to True).
+
+        Raises
+        ------
+        ShelleyError
+            If payments from the same address use different signing keys.
+        """
+
+        # Group the payments by the sending address. All payments from an
+        # address must be signed with the same key.
+        groups = {}
+        for amt, to_addr, from_addr, key_file in transfers:
+            group_key, receive_addrs, payments = groups.setdefault(
+                from_addr, (Path(key_file), [], [])
+            )
+            if group_key != Path(key_file):
+                raise ShelleyError(
+                    f"Payments from {from_addr} are signed with different "
+                    f"keys ({group_key} and {key_file})."
+                )
+            receive_addrs.append(to_addr)
+            payments.append(round(amt * 1_000_000))  # ADA to Lovelaces
+
+        # Transactions from different addresses spend different UTXOs so they
+        # can be built and sent concurrently.
+        workers = max(1, min(MAX_PARALLEL_CLI, len(groups)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    self._send_lovelaces,
+                    receive_addrs,
+                    payments,
+                    from_addr,
+                    key_file,
+                    offline,
+                    cleanup,
+                )
+                for from_addr, (key_file, receive_addrs, payments)
+                in groups.items()
+            ]
+        for future in futures:
+            future.result()
+
+    async def send_payment_async(
+        self, amt, to_addr, from_addr, key_file, offline=False, cleanup=True
+    ):
+        """Coroutine version of `send_payment`. The payment runs in the event
+        loop's default executor so other tasks can run while waiting on the
+        CLI. Payments from the same address should not overlap since they
+        would try to spend the same UTXOs; use `send_payments_bulk` instead.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            functools.partial(
+                self.send_payment,
+                amt,
+                to_addr,
+                from_addr,
+                key_file,
+                offline=offline,
+                cleanup=cleanup,
+            ),
+        )
 
+    def _send_lovelaces(
+        self, receive_addrs, payments, from_addr, key_file, offline, cleanup
+    ):
         # Build the transaction
         tx_raw_file = self.build_raw_transaction(
             from_addr,
             witness_count=1,
-            receive_addrs=[to_addr],
-            payments=[payment],
+            receive_addrs=receive_addrs,
+            payments=payments,
             certs=None,
             deposits=0,
             folder=None,
@@ -429,7 +1492,7 @@ class ShelleyTools:
         """
 
         # Build a transaction name
-        tx_name = datetime.now().strftime("reg_stake_key_%Y-%m-%d_%Hh%Mm%Ss")
+        tx_name = _tx_name("reg_stake_key")
 
         # Create a registration certificate
         key_file_path = Path(stake_vkey_file)
@@ -441,8 +1504,7 @@ class ShelleyTools:
         )
 
         # Determine the TTL
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
+        ttl = self.get_ttl()
 
         # Get a list of UTXOs and sort them in decending order by value.
         utxos = self.get_utxos(addr)
@@ -452,38 +1514,32 @@ class ShelleyTools:
                 f"Account {addr} cannot pay tranction costs because "
                 "it does not contain any ADA."
             )
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        utxos.sort(key=itemgetter("Lovelace"), reverse=True)
 
         # Ensure the parameters file exists
-        self.load_protocol_parameters()
-
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
-        utxo_total = 0
-        tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
-
-            # Build a transaction draft
-            self.run_cli(
-                f"{self.cli} transaction build-raw{tx_in_str} "
-                f"--tx-out {addr}+0 --ttl 0 --fee 0 "
-                f"--certificate-file {stake_cert_path} "
-                f"--out-file {tx_draft_file}"
-            )
-
-            # Calculate the minimum fee
-            min_fee = self.calc_min_fee(
-                tx_draft_file, utxo_count, tx_out_count=1, witness_count=2
-            )
+        params_file = self.load_protocol_parameters()
+        deposit = self.protocol_parameters["stakeAddressDeposit"]
 
-            # TX cost
-            cost = min_fee + self.protocol_parameters["stakeAddressDeposit"]
-            if utxo_total > cost:
-                break
+        # Find the UTXOs that pay for the transaction.
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        draft_cmd = f"{self.cli} transaction build-raw"
+        draft_args = (
+            f" --tx-out {addr}+0 --ttl 0 --fee 0 "
+            f"--certificate-file {stake_cert_path} "
+            f"--out-file {tx_draft_file}"
+        )
+        _, utxo_total, min_fee, tx_in_str = self._select_fee_inputs(
+            utxos,
+            draft_cmd,
+            draft_args,
+            tx_draft_file,
+            tx_out_count=1,
+            witness_count=2,
+            extra_bytes=self._cert_size(stake_cert_path),
+            required=deposit,
+            params_file=params_file,
+        )
+        cost = min_fee + deposit  # TX cost
 
         if utxo_total < cost:
             cost_ada = cost / 1_000_000
@@ -495,22 +1551,22 @@ class ShelleyTools:
             )
 
         # Build the transaction.
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
+        change = utxo_total - cost
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
-            f"--tx-out {addr}+{utxo_total - cost} "
+            f"{_change_arg(addr, change)}"
             f"--ttl {ttl} --fee {min_fee} "
             f"--certificate-file {stake_cert_path} "
             f"--out-file {tx_raw_file}"
         )
 
         # Sign the transaction with both the payment and stake keys.
-        tx_signed_file = Path(self.working_dir) / (tx_name + ".signed")
+        tx_signed_file = self.working_dir / (tx_name + ".signed")
         self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_raw_file} --signing-key-file {pmt_skey_file} "
-            f"--signing-key-file {stake_skey_file} {self.network} "
-            f"--out-file {tx_signed_file}"
+            self._sign_args(
+                tx_raw_file, [pmt_skey_file, stake_skey_file], tx_signed_file
+            )
         )
 
         # Delete the intermediate transaction files if specified.
@@ -544,25 +1600,24 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Generate the KES Key pair
+        cmd, kes_vkey, kes_skey = self._kes_keygen_cmd(pool_name, folder)
+        self.run_cli(cmd)
+
+        return (kes_vkey, kes_skey)
+
+    def _kes_keygen_cmd(self, pool_name, folder):
+        """Return the command generating a KES key pair and the key paths."""
         kes_vkey = folder / (pool_name + "_kes.vkey")
         kes_skey = folder / (pool_name + "_kes.skey")
-        self.run_cli(
+        cmd = (
             f"{self.cli} node key-gen-KES "
             f"--verification-key-file {kes_vkey} "
             f"--signing-key-file {kes_skey}"
         )
-
-        return (kes_vkey, kes_skey)
+        return (cmd, kes_vkey, kes_skey)
 
     def create_block_producing_keys(
         self, genesis_file, pool_name="pool", folder=None
@@ -591,62 +1646,55 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
-
-        # Generate Cold Keys and a Cold_counter
-        cold_vkey = folder / (pool_name + "_cold.vkey")
-        cold_skey = folder / (pool_name + "_cold.skey")
-        cold_counter = folder / (pool_name + "_cold.counter")
-        self.run_cli(
-            f"{self.cli} node key-gen "
-            f"--cold-verification-key-file {cold_vkey} "
-            f"--cold-signing-key-file {cold_skey} "
-            f"--operational-certificate-issue-counter-file {cold_counter}"
-        )
-
-        # Generate VRF Key pair
-        vrf_vkey = folder / (pool_name + "_vrf.vkey")
-        vrf_skey = folder / (pool_name + "_vrf.skey")
-        self.run_cli(
-            f"{self.cli} node key-gen-VRF "
-            f"--verification-key-file {vrf_vkey} "
-            f"--signing-key-file {vrf_skey}"
-        )
+        folder = self._ensure_folder(folder)
 
-        # Generate the KES Key pair
-        kes_vkey, kes_skey = self.generate_kes_keys(pool_name, folder)
-
-        # Get the network genesis parameters
-        json_data = self._load_text_file(genesis_file)
-        genesis_parameters = json.loads(json_data)
-
-        # Generate the Operational Certificate/
-        cert_file = folder / (pool_name + ".cert")
+        # Get the network genesis parameters and the current KES period.
+        genesis_parameters = self._load_genesis(genesis_file)
         slots_kes_period = genesis_parameters["slotsPerKESPeriod"]
-        tip = self.get_tip()
+        tip = self.get_tip(max_age=0)
         kes_period = tip // slots_kes_period  # Integer division
-        self.run_cli(
-            f"{self.cli} node issue-op-cert "
-            f"--kes-verification-key-file {kes_vkey} "
-            f"--cold-signing-key-file {cold_skey} "
-            f"--operational-certificate-issue-counter {cold_counter} "
-            f"--kes-period {kes_period} --out-file {cert_file}"
-        )
 
-        # Get the pool ID and return it.
-        result = self.run_cli(
-            f"{self.cli} stake-pool id "
-            f"--cold-verification-key-file {cold_vkey}"
+        # Generate the Cold Keys and a Cold_counter, the VRF Key pair and the
+        # KES Key pair (independent of each other, so run concurrently), then
+        # the Operational Certificate and get the pool ID. All of the commands
+        # are run as a single batch.
+        prefix = f"{folder}/{pool_name}"
+        cold_vkey = f"{prefix}_cold.vkey"
+        cold_skey = f"{prefix}_cold.skey"
+        cold_counter = f"{prefix}_cold.counter"
+        vrf_vkey = f"{prefix}_vrf.vkey"
+        vrf_skey = f"{prefix}_vrf.skey"
+        kes_cmd, kes_vkey, kes_skey = self._kes_keygen_cmd(pool_name, folder)
+        cert_file = f"{prefix}.cert"
+        result = self._run_cli_batch(
+            [
+                f"{self.cli} node issue-op-cert "
+                f"--kes-verification-key-file {kes_vkey} "
+                f"--cold-signing-key-file {cold_skey} "
+                f"--operational-certificate-issue-counter {cold_counter} "
+                f"--kes-period {kes_period} --out-file {cert_file}",
+                f"{self.cli} stake-pool id "
+                f"--cold-verification-key-file {cold_vkey}",
+            ],
+            parallel=[
+                f"{self.cli} node key-gen "
+                f"--cold-verification-key-file {cold_vkey} "
+                f"--cold-signing-key-file {cold_skey} "
+                f"--operational-certificate-issue-counter-file {cold_counter}",
+                f"{self.cli} node key-gen-VRF "
+                f"--verification-key-file {vrf_vkey} "
+                f"--signing-key-file {vrf_skey}",
+                kes_cmd,
+            ],
         )
-        pool_id = result.stdout
-        self._dump_text_file(folder / (pool_name + ".id"), pool_id)
+        if result.returncode != 0:
+            raise ShelleyError(
+                f"Unable to create block producing keys: {result.stderr}"
+            )
+
+        # The pool ID is the output of the last command.
+        pool_id = result.stdout.splitlines()[-1].strip()
+        self._dump_text_file(f"{prefix}.id", pool_id)
 
         return pool_id  # Return the pool id after first saving it to a file.
 
@@ -676,37 +1724,30 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
-
-        # Generate the new KES key pair
-        kes_vkey, kes_skey = self.generate_kes_keys(pool_name, folder)
-
-        # Generate the new pool operation certificate
-        # Get the network genesis parameters
-        json_data = self._load_text_file(genesis_file)
-        genesis_parameters = json.loads(json_data)
+        folder = self._ensure_folder(folder)
 
-        # Generate the Operational Certificate
-        cert_file = folder / (pool_name + ".cert")
+        # Get the network genesis parameters and the current KES period.
+        genesis_parameters = self._load_genesis(genesis_file)
         slots_kes_period = genesis_parameters["slotsPerKESPeriod"]
-        tip = self.get_tip()
+        tip = self.get_tip(max_age=0)
         kes_period = tip // slots_kes_period  # Integer division
-        result = self.run_cli(
-            f"{self.cli} node issue-op-cert "
-            f"--kes-verification-key-file {kes_vkey} "
-            f"--cold-signing-key-file {cold_skey} "
-            f"--operational-certificate-issue-counter {cold_counter} "
-            f"--kes-period {kes_period} --out-file {cert_file}"
+
+        # Generate the new KES key pair and the new pool operational
+        # certificate in a single batch of commands.
+        kes_cmd, kes_vkey, kes_skey = self._kes_keygen_cmd(pool_name, folder)
+        cert_file = folder / (pool_name + ".cert")
+        result = self._run_cli_batch(
+            [
+                kes_cmd,
+                f"{self.cli} node issue-op-cert "
+                f"--kes-verification-key-file {kes_vkey} "
+                f"--cold-signing-key-file {cold_skey} "
+                f"--operational-certificate-issue-counter {cold_counter} "
+                f"--kes-period {kes_period} --out-file {cert_file}",
+            ]
         )
 
-        if result.stderr:
+        if result.returncode != 0:
             raise ShelleyError(f"Unable to rotate KES keys: {result.stderr}")
 
 
@@ -716,27 +1757,28 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Create a JSON file with the pool metadata and return the file hash.
         ticker = pool_metadata["ticker"]
         metadata_file_path = folder / f"{ticker}_metadata.json"
-        self._dump_text_file(
-            metadata_file_path, json.dumps(pool_metadata).strip()
-        )
-        result = self.run_cli(
-            f"{self.cli} stake-pool metadata-hash "
-            f"--pool-metadata-file {metadata_file_path}"
-        )
-        metadata_hash = result.stdout.strip()
-        return metadata_hash
+        metadata_json = _json_dumps(pool_metadata)
+        self._dump_text_file(metadata_file_path, metadata_json)
+        return _blake2b_256(metadata_json.encode())
+
+    def _metadata_hash(self, metadata_file) -> str:
+        """Return the hash of a pool metadata file. Local files are hashed
+        in-process rather than with "stake-pool metadata-hash".
+        """
+        if self.ssh is not None:
+            result = self.run_cli(
+                f"{self.cli} stake-pool metadata-hash "
+                f"--pool-metadata-file {metadata_file}"
+            )
+            return result.stdout.strip()
+
+        with open(metadata_file, "rb") as infile:
+            return _blake2b_256(infile.read())
 
     def generate_stake_pool_cert(
         self,
@@ -802,14 +1844,7 @@ class ShelleyTools:
         """
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Get the hash of the JSON file if the URL is provided and the hash is
         # not specified.
@@ -818,11 +1853,7 @@ class ShelleyTools:
             if pool_metadata_hash is None:
                 metadata_file = folder / "metadata_file_download.json"
                 self._download_file(pool_metadata_url, metadata_file)
-                result = self.run_cli(
-                    f"{self.cli} stake-pool metadata-hash "
-                    f"--pool-metadata-file {metadata_file}"
-                )
-                pool_metadata_hash = result.stdout.strip()
+                pool_metadata_hash = self._metadata_hash(metadata_file)
 
             # Create the arg string for the pool cert.
             metadata_args = (
@@ -830,34 +1861,16 @@ class ShelleyTools:
                 f"--metadata-hash {pool_metadata_hash}"
             )
 
-        # Create the relay arg string. Basically, we need a port and host arg
-        # but there can be different forms of the host argument. See the
-        # caradno-cli documentation. The simpliest way I could figure was to
-        # use a list of dictionaries where each dict represents a relay.
-        relay_args = ""
-        for relay in pool_relays:
-            if "ipv4" in relay["host-type"]:
-                host_arg = f"--pool-relay-ipv4 {relay['host']}"
-            elif "ipv6" in relay["host-type"]:
-                host_arg = f"--pool-relay-ipv4 {relay['host']}"
-            elif "single" in relay["host-type"]:
-                host_arg = f"--single-host-pool-relay {relay['host']}"
-            elif "multi" in relay["host-type"]:
-                relay_args += f"--multi-host-pool-relay {relay['host']}"
-                continue  # No port info for this case
-            else:
-                continue  # Skip if invalid host type
-            port_arg = f"--pool-relay-port {relay['port']}"
-            relay_args += f"{host_arg} {port_arg} "
+        relay_args = _relay_args(pool_relays)
 
         # Create the argument string for the list of owner verification keys.
-        owner_vkey_args = ""
-        for key_path in owner_stake_vkeys:
-            arg = f"--pool-owner-stake-verification-key-file {key_path} "
-            owner_vkey_args += arg
+        owner_vkey_args = "".join(
+            f"--pool-owner-stake-verification-key-file {key_path} "
+            for key_path in owner_stake_vkeys
+        )
 
         # Generate Stake pool registration certificate
-        ts = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
+        ts = _tx_name("tx")
         pool_cert_path = folder / (pool_name + "_registration_" + ts + ".cert")
         self.run_cli(
             f"{self.cli} stake-pool registration-certificate "
@@ -892,34 +1905,41 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Generate delegation certificate (pledge from each owner)
-        ts = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
-        certs = []
-        for key_path in owner_stake_vkeys:
-            key_path = Path(key_path)
-            cert_path = key_path.parent / (
-                key_path.stem + "_delegation_" + ts + ".cert"
-            )
-            self.run_cli(
-                f"{self.cli} stake-address delegation-certificate "
-                f"--stake-verification-key-file {key_path} "
-                f"--cold-verification-key-file {pool_cold_vkey} "
-                f"--out-file {cert_path}"
-            )
-            certs.append(cert_path)
+        ts = _tx_name("tx")
+        key_paths = [Path(key_path) for key_path in owner_stake_vkeys]
+        certs = [
+            key_path.parent / (key_path.stem + "_delegation_" + ts + ".cert")
+            for key_path in key_paths
+        ]
+        self._gen_delegation_certs(key_paths, certs, pool_cold_vkey)
 
         # Return a list of certificate files
         return certs
 
+    def _gen_delegation_certs(self, stake_vkeys, cert_paths, pool_cold_vkey):
+        # The certificates are independent of each other so they are
+        # generated concurrently.
+        if not stake_vkeys:
+            return
+        pool_cold_vkey = os.fspath(pool_cold_vkey)
+        result = self._run_cli_batch(
+            [],
+            parallel=[
+                f"{self.cli} stake-address delegation-certificate "
+                f"--stake-verification-key-file {os.fspath(key_path)} "
+                f"--cold-verification-key-file {pool_cold_vkey} "
+                f"--out-file {os.fspath(cert_path)}"
+                for key_path, cert_path in zip(stake_vkeys, cert_paths)
+            ],
+        )
+        if result.returncode != 0:
+            raise ShelleyError(
+                f"Unable to create delegation certificates: {result.stderr}"
+            )
+
     def build_raw_transaction(
         self,
         payment_addr,
@@ -930,6 +1950,7 @@ class ShelleyTools:
         deposits=0,
         folder=None,
         cleanup=True,
+        utxos=None,
     ) -> str:
         """Build a raw (unsigned) transaction.
 
@@ -950,6 +1971,10 @@ class ShelleyTools:
         cleanup : bool, optional
             Flag that indicates if the temporary transaction files should be
             removed when finished (defaults to True).
+        utxos : list, optional
+            UTXOs of the payment address containing only lovelace, as returned
+            by `get_utxos` with filter="Lovelace". Passing them skips querying
+            the node again (defaults to querying them).
 
         Returns
         -------
@@ -959,20 +1984,13 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Get a list of certificate arguments
-        cert_args = ""
-        if certs:
-            for cert_path in certs:
-                cert_args += f"--certificate-file {cert_path} "
+        cert_args = "".join(
+            f"--certificate-file {os.fspath(cert_path)} "
+            for cert_path in certs or []
+        )
 
         # Sume the total payments
         total_payments = 0
@@ -983,56 +2001,177 @@ class ShelleyTools:
         pymt_args_zero = ""
         pymt_args = ""
         if receive_addrs:
-            for addr, amt in zip(receive_addrs, payments):
-                pymt_args_zero += f"--tx-out {addr}+0 "
-                pymt_args += f"--tx-out {addr}+{amt:.0f} "
+            pymt_args_zero = "".join(
+                f"--tx-out {addr}+0 " for addr in receive_addrs
+            )
+            pymt_args = "".join(
+                f"--tx-out {addr}+{amt:.0f} "
+                for addr, amt in zip(receive_addrs, payments)
+            )
 
         # Get a list of UTXOs and sort them in decending order by value.
-        utxos = self.get_utxos(payment_addr, filter="Lovelace")
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        if utxos is None:
+            utxos = self.get_utxos(payment_addr, filter="Lovelace")
+        utxos = sorted(utxos, key=itemgetter("Lovelace"), reverse=True)
 
         # Determine the TTL
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
+        ttl = self.get_ttl()
 
         # Ensure the parameters file exists
-        self.load_protocol_parameters()
+        params_file = self.load_protocol_parameters()
         min_utxo = self.protocol_parameters["minUTxOValue"]
 
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_name = datetime.now().strftime("tx_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
+        # UTXOs that are worth less than the fee for adding them as an input
+        # would only make the transaction larger, so leave them out.
+        # Only as many UTXOs as fit in the transaction are considered.
+        fee_per_byte = self.protocol_parameters["txFeePerByte"]
+        utxos = _drop_dust(utxos, TX_IN_SIZE * fee_per_byte)
+        tx_out_count = 1 + len(receive_addrs or [])
+        utxos = utxos[: self._max_tx_inputs(tx_out_count, witness_count)]
+
+        tx_name = _tx_name("tx")
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        tx_in_args = [f"--tx-in {u['TxHash']}#{u['TxIx']} " for u in utxos]
+        utxo_totals = list(
+            itertools.accumulate(utxo["Lovelace"] for utxo in utxos)
+        )
+        draft_args = (
+            f"--tx-out {payment_addr}+0 {pymt_args_zero} --ttl 0 --fee 0 "
+            f"--out-file {tx_draft_file} {cert_args}"
+        )
+        drafts = {}
+        draft_head = self._cli_args("transaction", "build-raw")
+        draft_tail = shlex.split(draft_args)
+        tx_in_argv = [
+            arg
+            for utxo in utxos
+            for arg in ("--tx-in", f"{utxo['TxHash']}#{utxo['TxIx']}")
+        ]
+
+        def try_utxo_count(utxo_count):
+            # Build a draft spending the largest `utxo_count` UTXOs and check
+            # if they have enough Lovelaces to cover the transaction.
+            if utxo_count not in drafts:
+                min_fee = self._draft_min_fee(
+                    draft_head + tx_in_argv[: 2 * utxo_count] + draft_tail,
+                    tx_draft_file,
+                    utxo_count,
+                    tx_out_count=tx_out_count,
+                    witness_count=witness_count,
+                    protocol_params_file=params_file,
+                )
+                self.calibrate_fee_estimate(
+                    min_fee, utxo_count, tx_out_count, witness_count
+                )
+                utxo_total = utxo_totals[utxo_count - 1]
+                lovelaces_out = min_fee + deposits + total_payments
+                utxo_amt = utxo_total - lovelaces_out
+                covered = utxo_total > lovelaces_out and (
+                    utxo_amt > min_utxo or utxo_amt == 0
+                )
+                drafts[utxo_count] = (covered, min_fee, lovelaces_out)
+            return drafts[utxo_count][0]
+
         lovelaces_out = sys.maxsize  # must be larger than zero
         utxo_total = 0
         min_fee = 1  # make this start greater than utxo_total
         tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f"--tx-in {utxo['TxHash']}#{utxo['TxIx']} "
 
-            # Build a transaction draft
-            self.run_cli(
-                f"{self.cli} transaction build-raw {tx_in_str}"
-                f"--tx-out {payment_addr}+0 {pymt_args_zero} --ttl 0 --fee 0 "
-                f"--out-file {tx_draft_file} {cert_args}"
+        # First look for UTXOs that cover the payments with an excess small
+        # enough to add to the fee, so the transaction needs no change output.
+        changeless = None
+        if utxos and receive_addrs:
+            changeless = _select_utxos(
+                utxos,
+                deposits
+                + total_payments
+                + self.estimate_min_fee(0, len(receive_addrs), witness_count),
+                fee_per_input=TX_IN_SIZE * fee_per_byte,
+                cost_of_change=TX_OUT_SIZE * fee_per_byte,
             )
-
-            # Calculate the minimum fee
-            min_fee = self.calc_min_fee(
+        if changeless:
+            tx_in_str = "".join(
+                f"--tx-in {u['TxHash']}#{u['TxIx']} " for u in changeless
+            )
+            min_fee = self._draft_min_fee(
+                f"{self.cli} transaction build-raw {tx_in_str}"
+                f"{pymt_args_zero} --ttl 0 --fee 0 "
+                f"--out-file {tx_draft_file} {cert_args}",
                 tx_draft_file,
-                utxo_count,
-                tx_out_count=1,
+                len(changeless),
+                tx_out_count=len(receive_addrs),
                 witness_count=witness_count,
+                protocol_params_file=params_file,
+            )
+            self.calibrate_fee_estimate(
+                min_fee, len(changeless), len(receive_addrs), witness_count
             )
 
-            # If we have enough Lovelaces to cover the transaction can stop
-            # iterating through the UTXOs.
-            lovelaces_out = min_fee + deposits + total_payments
+            # The whole excess is paid as the fee; that is only possible if it
+            # is at least the minimum fee.
+            utxo_total = sum(utxo["Lovelace"] for utxo in changeless)
+            excess = utxo_total - deposits - total_payments
+            if excess >= min_fee:
+                min_fee = excess
+                lovelaces_out = utxo_total
+                utxo_amt = 0
+            else:
+                changeless = None
+                utxo_total = 0
+                min_fee = 1
+                tx_in_str = ""
+
+        # Otherwise find the fewest UTXOs that cover the transaction. Start
+        # from the count the linear fee formula calls for, widen the range in
+        # doubling steps until it holds the answer, then binary search within
+        # it. Each step is one draft so this takes O(log N) CLI calls rather
+        # than one per UTXO.
+        if utxos and not changeless:
+            guess = len(utxos)
+            for idx, utxo_total in enumerate(utxo_totals):
+                est_fee = self.estimate_min_fee(
+                    idx + 1, tx_out_count, witness_count
+                )
+                if utxo_total - est_fee - deposits - total_payments > min_utxo:
+                    guess = idx + 1
+                    break
+
+            # lo is the largest count known to fall short (zero always does)
+            # and hi the smallest count known to cover the transaction.
+            lo, hi = 0, None
+            if try_utxo_count(guess):
+                hi = guess
+            else:
+                lo = guess
+            step = 1
+            while hi is None and lo < len(utxos):
+                utxo_count = min(lo + step, len(utxos))
+                if try_utxo_count(utxo_count):
+                    hi = utxo_count
+                else:
+                    lo = utxo_count
+                step *= 2
+            step = 1
+            while hi is not None and lo == 0 and hi > 1:
+                utxo_count = max(hi - step, 1)
+                if try_utxo_count(utxo_count):
+                    hi = utxo_count
+                else:
+                    lo = utxo_count
+                step *= 2
+            while hi is not None and hi - lo > 1:
+                utxo_count = (lo + hi) // 2
+                if try_utxo_count(utxo_count):
+                    hi = utxo_count
+                else:
+                    lo = utxo_count
+
+            # If no count covers the transaction, report on spending them all.
+            utxo_count = hi if hi is not None else len(utxos)
+            _, min_fee, lovelaces_out = drafts[utxo_count]
+            utxo_total = utxo_totals[utxo_count - 1]
             utxo_amt = utxo_total - lovelaces_out
-            if utxo_total > lovelaces_out and (utxo_amt > min_utxo or utxo_amt == 0):
-                break
+            tx_in_str = "".join(tx_in_args[:utxo_count])
 
         # Handle the error case where there is not enough inputs for the output
         cost_ada = lovelaces_out / 1_000_000
@@ -1070,7 +2209,7 @@ class ShelleyTools:
             utxo_str = f"--tx-out {payment_addr}+{utxo_amt}"
 
         # Build the transaction to the blockchain.
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
         self.run_cli(
             f"{self.cli} transaction build-raw {tx_in_str} {utxo_str} "
             f"{pymt_args} --ttl {ttl} --fee {min_fee} "
@@ -1093,6 +2232,7 @@ class ShelleyTools:
         start_slot=None,
         end_slot=None,
         folder=None,
+        pretty=False,
     ) -> str:
         """Helper function for building multi-signature scripts.
 
@@ -1112,6 +2252,9 @@ class ShelleyTools:
             Lower bound on slots where minting is allowed 
         end_slot : int, optional
             Upper bound on slots where minting is allowed
+        pretty : bool, optional
+            Indent the script file for reading by people (defaults to False,
+            which writes compact JSON).
 
         Returns
         -------
@@ -1121,14 +2264,7 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Build the list of signature hashes
         script = {
@@ -1142,21 +2278,26 @@ class ShelleyTools:
         elif sig_type == "atleast" and required is not None:
             script["type"] = "atLeast"
             script["required"] = int(required)
-            if script["required"] < 1 or script["required"] >= len(key_hashes):
+            if script["required"] < 1 or script["required"] > len(key_hashes):
                 raise ShelleyError("Invalid number of required signatures.")
         else:
             script["type"] = "all"
 
         # Add bounds
+        bounds = []
         if start_slot is not None:
-            script["scripts"].append({"slot": start_slot, "type": "after"})
+            bounds.append({"slot": start_slot, "type": "after"})
         if end_slot is not None:
-            script["scripts"].append({"slot": start_slot, "type": "before"})
+            bounds.append({"slot": end_slot, "type": "before"})
+        script["scripts"].extend(bounds)
 
         # Write the script file
-        file_path = Path(folder) / (script_name + ".json")
-        with open(file_path, "w") as outfile:
-            json.dump(script, outfile, indent=4)
+        file_path = folder / (script_name + ".json")
+        if pretty:
+            script_json = json.dumps(script, indent=4)
+        else:
+            script_json = _json_dumps(script)
+        self._dump_text_file(file_path, script_json)
 
         return file_path
 
@@ -1177,9 +2318,9 @@ class ShelleyTools:
         """
 
         # Generate a list of witness args.
-        witness_args = ""
-        for witness in witnesses:
-            witness_args += f"--witness-file {witness} "
+        witness_args = "".join(
+            f"--witness-file {os.fspath(witness)} " for witness in witnesses
+        )
 
         # Sign the transaction with the signing key
         tx_name = Path(tx_file).stem
@@ -1193,6 +2334,24 @@ class ShelleyTools:
         # Return the path to the signed file for downstream use.
         return tx_signed_file
 
+    def _sign_args(self, tx_file, skeys, signed_file) -> list:
+        """Return the "transaction sign" command as a list of arguments."""
+        key_args = [
+            arg
+            for key_path in skeys
+            for arg in ("--signing-key-file", os.fspath(key_path))
+        ]
+        return self._cli_args(
+            "transaction",
+            "sign",
+            "--tx-body-file",
+            os.fspath(tx_file),
+            *key_args,
+            *self.network.split(),
+            "--out-file",
+            os.fspath(signed_file),
+        )
+
     def sign_transaction(self, tx_file, skeys) -> str:
         """Sign a transaction file with a signing key.
 
@@ -1209,21 +2368,12 @@ class ShelleyTools:
             Path to the signed transaction file.
         """
 
-        # Generate a list of signing key args.
-        signing_key_args = ""
-        for key_path in skeys:
-            signing_key_args += f"--signing-key-file {key_path} "
-        
         # Sign the transaction with the signing key
         tx_name = Path(tx_file).stem
         tx_signed_file = tx_name + ".signed"
-        result = self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_file} {signing_key_args} "
-            f"{self.network} --out-file {tx_signed_file}"
-        )
+        result = self.run_cli(self._sign_args(tx_file, skeys, tx_signed_file))
 
-        if result.stderr:
+        if result.returncode != 0:
             raise ShelleyError(f"Unable to sign transaction: {result.stderr}")
 
         # Return the path to the signed file for downstream use.
@@ -1248,7 +2398,7 @@ class ShelleyTools:
             f"--tx-file {signed_tx_file} {self.network}"
         )
 
-        if result.stderr:
+        if result.returncode != 0:
             raise ShelleyError(f"Unable to submit transaction: {result.stderr}")
 
         # Delete the transaction files if specified.
@@ -1276,6 +2426,7 @@ class ShelleyTools:
         folder=None,
         offline=False,
         cleanup=True,
+        utxos=None,
     ):
         """Register a stake pool on the blockchain.
 
@@ -1335,18 +2486,15 @@ class ShelleyTools:
         cleanup : bool, optional
             Flag that indicates if the temporary transaction files should be
             removed when finished (defaults to True).
+        utxos : list, optional
+            UTXOs of the payment address containing only lovelace, as returned
+            by `get_utxos` with filter="Lovelace". Passing them skips querying
+            the node again (defaults to querying them).
         """
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         pool_cert_path = self.generate_stake_pool_cert(
             pool_name,
@@ -1367,58 +2515,55 @@ class ShelleyTools:
         del_certs = self.generate_delegation_cert(
             owner_stake_vkeys, pool_cold_vkey, folder=folder
         )
-        del_cert_args = ""
-        for cert_path in del_certs:
-            del_cert_args += f"--certificate-file {cert_path} "
+        del_cert_args = "".join(
+            f"--certificate-file {os.fspath(cert_path)} "
+            for cert_path in del_certs
+        )
 
-        # Generate a list of owner signing key args.
-        signing_key_args = ""
-        for key_path in owner_stake_skeys:
-            signing_key_args += f"--signing-key-file {key_path} "
+        # The transaction is signed by the payment key, the owner stake keys
+        # and the pool cold key.
+        signing_keys = [payment_skey, *owner_stake_skeys, pool_cold_skey]
 
         # Get the pool deposit from the network genesis parameters.
-        json_data = self._load_text_file(genesis_file)
-        pool_deposit = json.loads(json_data)["protocolParams"]["poolDeposit"]
+        genesis_parameters = self._load_genesis(genesis_file)
+        pool_deposit = genesis_parameters["protocolParams"]["poolDeposit"]
 
-        # Get a list of UTXOs and sort them in decending order by value.
-        utxos = self.get_utxos(payment_addr)
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        # Get a list of UTXOs and sort them in decending order by value. Only
+        # lovelace is sent back to the payment address, so UTXOs holding
+        # other tokens are left alone.
+        if utxos is None:
+            utxos = self.get_utxos(payment_addr, filter="Lovelace")
+        utxos = sorted(utxos, key=itemgetter("Lovelace"), reverse=True)
 
         # Determine the TTL
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
+        ttl = self.get_ttl()
 
         # Ensure the parameters file exists
-        self.load_protocol_parameters()
-
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_name = datetime.now().strftime("reg_pool_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
-        utxo_total = 0
-        min_fee = 1  # make this start greater than utxo_total
-        tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
-
-            # Build a transaction draft
-            self.run_cli(
-                f"{self.cli} transaction build-raw{tx_in_str} "
-                f"--tx-out {payment_addr}+0 --ttl 0 --fee 0 "
-                f"--out-file {tx_draft_file} "
-                f"--certificate-file {pool_cert_path} {del_cert_args}"
-            )
-
-            # Calculate the minimum fee
-            nwit = len(owner_stake_skeys) + 2
-            min_fee = self.calc_min_fee(
-                tx_draft_file, utxo_count, tx_out_count=1, witness_count=nwit
-            )
+        params_file = self.load_protocol_parameters()
 
-            if utxo_total > (min_fee + pool_deposit + 10):
-                break
+        # Find the UTXOs that pay for the transaction.
+        tx_name = _tx_name("reg_pool")
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        cert_size = self._cert_size(pool_cert_path) + sum(
+            self._cert_size(cert_path) for cert_path in del_certs
+        )
+        draft_cmd = f"{self.cli} transaction build-raw"
+        draft_args = (
+            f" --tx-out {payment_addr}+0 --ttl 0 --fee 0 "
+            f"--out-file {tx_draft_file} "
+            f"--certificate-file {pool_cert_path} {del_cert_args}"
+        )
+        _, utxo_total, min_fee, tx_in_str = self._select_fee_inputs(
+            utxos,
+            draft_cmd,
+            draft_args,
+            tx_draft_file,
+            tx_out_count=1,
+            witness_count=len(owner_stake_skeys) + 2,
+            extra_bytes=cert_size,
+            required=pool_deposit + 10,
+            params_file=params_file,
+        )
 
         if utxo_total < (min_fee + pool_deposit):
             cost_ada = (min_fee + pool_deposit) / 1_000_000
@@ -1431,21 +2576,19 @@ class ShelleyTools:
 
         # Build the transaction to submit the pool certificate and delegation
         # certificate(s) to the blockchain.
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
+        change = utxo_total - min_fee - pool_deposit
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
-            f"--tx-out {payment_addr}+{utxo_total - min_fee - pool_deposit} "
+            f"{_change_arg(payment_addr, change)}"
             f"--ttl {ttl} --fee {min_fee} --out-file {tx_raw_file} "
             f"--certificate-file {pool_cert_path} {del_cert_args}"
         )
 
         # Sign the transaction with both the payment and stake keys.
-        tx_signed_file = Path(self.working_dir) / (tx_name + ".signed")
+        tx_signed_file = self.working_dir / (tx_name + ".signed")
         self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_raw_file} --signing-key-file {payment_skey} "
-            f"{signing_key_args} --signing-key-file {pool_cold_skey} "
-            f"{self.network} --out-file {tx_signed_file}"
+            self._sign_args(tx_raw_file, signing_keys, tx_signed_file)
         )
 
         # Delete the transaction files if specified.
@@ -1543,14 +2686,7 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
         # Get the hash of the JSON file if the URL is provided and the hash is
         # not specified.
@@ -1559,11 +2695,7 @@ class ShelleyTools:
             if pool_metadata_hash is None:
                 metadata_file = folder / "metadata_file_download.json"
                 self._download_file(pool_metadata_url, metadata_file)
-                result = self.run_cli(
-                    f"{self.cli} stake-pool metadata-hash "
-                    f"--pool-metadata-file {metadata_file}"
-                )
-                pool_metadata_hash = result.stdout.strip()
+                pool_metadata_hash = self._metadata_hash(metadata_file)
 
             # Create the arg string for the pool cert.
             metadata_args = (
@@ -1571,31 +2703,23 @@ class ShelleyTools:
                 f"--metadata-hash {pool_metadata_hash}"
             )
 
-        # Create the relay arg string. Basically, we need a port and host arg
-        # but there can be different forms of the host argument. See the
-        # caradno-cli documentation. The simpliest way I could figure was to
-        # use a list of dictionaries where each dict represents a relay.
-        relay_args = ""
-        for relay in pool_relays:
-            if "ipv4" in relay["host-type"]:
-                host_arg = f"--pool-relay-ipv4 {relay['host']}"
-            elif "ipv6" in relay["host-type"]:
-                host_arg = f"--pool-relay-ipv4 {relay['host']}"
-            elif "single" in relay["host-type"]:
-                host_arg = f"--single-host-pool-relay {relay['host']}"
-            elif "multi" in relay["host-type"]:
-                relay_args += f"--multi-host-pool-relay {relay['host']}"
-                continue  # No port info for this case
-            else:
-                continue  # Skip if invalid host type
-            port_arg = f"--pool-relay-port {relay['port']}"
-            relay_args += f"{host_arg} {port_arg} "
+        relay_args = _relay_args(pool_relays)
 
-        # Create the argument string for the list of owner verification keys.
-        owner_vkey_args = ""
+        # Create the argument string for the list of owner verification keys
+        # and the paths of their delegation certificates in one pass.
+        owner_vkey_parts = []
+        key_paths = []
+        del_certs = []
         for key_path in owner_stake_vkeys:
-            arg = f"--pool-owner-stake-verification-key-file {key_path} "
-            owner_vkey_args += arg
+            owner_vkey_parts.append(
+                f"--pool-owner-stake-verification-key-file {key_path} "
+            )
+            key_path = Path(key_path)
+            key_paths.append(key_path)
+            del_certs.append(
+                key_path.parent / (key_path.stem + "_delegation.cert")
+            )
+        owner_vkey_args = "".join(owner_vkey_parts)
 
         # Generate Stake pool registration certificate
         pool_cert_path = folder / (pool_name + "_registration.cert")
@@ -1614,65 +2738,52 @@ class ShelleyTools:
         # TODO: Edit the cert free text?
 
         # Generate delegation certificate (pledge from each owner)
-        del_cert_args = ""
-        signing_key_args = ""
-        for key_path in owner_stake_vkeys:
-            key_path = Path(key_path)
-            cert_path = key_path.parent / (key_path.stem + "_delegation.cert")
-            del_cert_args += f"--certificate-file {cert_path} "
-            self.run_cli(
-                f"{self.cli} stake-address delegation-certificate "
-                f"--stake-verification-key-file {key_path} "
-                f"--cold-verification-key-file {pool_cold_vkey} "
-                f"--out-file {cert_path}"
-            )
+        self._gen_delegation_certs(key_paths, del_certs, pool_cold_vkey)
+        del_cert_args = "".join(
+            f"--certificate-file {os.fspath(cert_path)} "
+            for cert_path in del_certs
+        )
 
-        # Generate a list of owner signing key args.
-        for key_path in owner_stake_skeys:
-            signing_key_args += f"--signing-key-file {key_path} "
+        # The transaction is signed by the payment key, the owner stake keys
+        # and the pool cold key.
+        signing_keys = [payment_skey, *owner_stake_skeys, pool_cold_skey]
 
         # Get the pool deposit from the network genesis parameters.
         pool_deposit = 0  # re-registration doesn't require deposit
 
         # Get a list of UTXOs and sort them in decending order by value.
         utxos = self.get_utxos(payment_addr)
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        utxos.sort(key=itemgetter("Lovelace"), reverse=True)
 
         # Determine the TTL
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
+        ttl = self.get_ttl()
 
         # Ensure the parameters file exists
-        self.load_protocol_parameters()
-
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_name = datetime.now().strftime("reg_pool_%Y-%m-%d_%Hh%Mm%Ss")
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
-        utxo_total = 0
-        min_fee = 1  # make this start greater than utxo_total
-        tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
-
-            # Build a transaction draft
-            self.run_cli(
-                f"{self.cli} transaction build-raw{tx_in_str} "
-                f"--tx-out {payment_addr}+0 --ttl 0 --fee 0 "
-                f"--out-file {tx_draft_file} "
-                f"--certificate-file {pool_cert_path} {del_cert_args}"
-            )
-
-            # Calculate the minimum fee
-            nwit = len(owner_stake_skeys) + 2
-            min_fee = self.calc_min_fee(
-                tx_draft_file, utxo_count, tx_out_count=1, witness_count=nwit
-            )
+        params_file = self.load_protocol_parameters()
 
-            if utxo_total > (min_fee + pool_deposit):
-                break
+        # Find the UTXOs that pay for the transaction.
+        tx_name = _tx_name("reg_pool")
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        cert_size = self._cert_size(pool_cert_path) + sum(
+            self._cert_size(cert_path) for cert_path in del_certs
+        )
+        draft_cmd = f"{self.cli} transaction build-raw"
+        draft_args = (
+            f" --tx-out {payment_addr}+0 --ttl 0 --fee 0 "
+            f"--out-file {tx_draft_file} "
+            f"--certificate-file {pool_cert_path} {del_cert_args}"
+        )
+        _, utxo_total, min_fee, tx_in_str = self._select_fee_inputs(
+            utxos,
+            draft_cmd,
+            draft_args,
+            tx_draft_file,
+            tx_out_count=1,
+            witness_count=len(owner_stake_skeys) + 2,
+            extra_bytes=cert_size,
+            required=pool_deposit,
+            params_file=params_file,
+        )
 
         if utxo_total < min_fee:
             cost_ada = (min_fee + pool_deposit) / 1_000_000
@@ -1685,21 +2796,19 @@ class ShelleyTools:
 
         # Build the transaction to submit the pool certificate and delegation
         # certificate(s) to the blockchain.
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
+        change = utxo_total - min_fee - pool_deposit
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
-            f"--tx-out {payment_addr}+{utxo_total - min_fee - pool_deposit} "
+            f"{_change_arg(payment_addr, change)}"
             f"--ttl {ttl} --fee {min_fee} --out-file {tx_raw_file} "
             f"--certificate-file {pool_cert_path} {del_cert_args}"
         )
 
         # Sign the transaction with both the payment and stake keys.
-        tx_signed_file = Path(self.working_dir) / (tx_name + ".signed")
+        tx_signed_file = self.working_dir / (tx_name + ".signed")
         self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_raw_file} --signing-key-file {payment_skey} "
-            f"{signing_key_args} --signing-key-file {pool_cold_skey} "
-            f"{self.network} --out-file {tx_signed_file}"
+            self._sign_args(tx_raw_file, signing_keys, tx_signed_file)
         )
 
         # Delete the transaction files if specified.
@@ -1767,17 +2876,20 @@ class ShelleyTools:
             )
 
         # Get the network genesis parameters
-        with open(genesis_file, "r") as genfile:
-            genesis_parameters = json.load(genfile)
+        genesis_parameters = self._load_genesis(genesis_file)
         epoch_length = genesis_parameters["epochLength"]
 
-        # Determine the TTL
-        tip = self.get_tip()
+        # Determine the TTL. The current epoch is also needed so use a fresh
+        # tip.
+        tip = self.get_tip(max_age=0)
         ttl = tip + self.ttl_buffer
 
         # Get the current epoch
         epoch = tip // epoch_length
 
+        # Build a transaction name, used for all of the transaction files.
+        tx_name = _tx_name("pool_dereg_tx")
+
         # Create deregistration certificate
         pool_dereg = self.working_dir / "pool.dereg"
         self.run_cli(
@@ -1788,32 +2900,25 @@ class ShelleyTools:
 
         # Get a list of UTXOs and sort them in decending order by value.
         utxos = self.get_utxos(payment_addr)
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
-
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_draft_file = self.working_dir / "pool_dereg_tx.draft"
-        utxo_total = 0
-        tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
-
-            # Build a transaction draft
-            self.run_cli(
-                f"{self.cli} transaction build-raw{tx_in_str} "
-                f"--tx-out {payment_addr}+0 --ttl 0 --fee 0 "
-                f"--out-file {tx_draft_file} --certificate-file {pool_dereg}"
-            )
-
-            # Calculate the minimum fee
-            min_fee = self.calc_min_fee(
-                tx_draft_file, utxo_count, tx_out_count=1, witness_count=2
-            )
-
-            if utxo_total > min_fee:
-                break
+        utxos.sort(key=itemgetter("Lovelace"), reverse=True)
+
+        # Find the UTXOs that pay for the transaction.
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        draft_cmd = f"{self.cli} transaction build-raw"
+        draft_args = (
+            f" --tx-out {payment_addr}+0 --ttl 0 --fee 0 "
+            f"--out-file {tx_draft_file} --certificate-file {pool_dereg}"
+        )
+        _, utxo_total, min_fee, tx_in_str = self._select_fee_inputs(
+            utxos,
+            draft_cmd,
+            draft_args,
+            tx_draft_file,
+            tx_out_count=1,
+            witness_count=2,
+            extra_bytes=self._cert_size(pool_dereg),
+            params_file=params_file,
+        )
 
         if utxo_total < min_fee:
             # cost_ada = min_fee/1_000_000
@@ -1825,22 +2930,21 @@ class ShelleyTools:
             )
 
         # Build the raw transaction
-        tx_raw_file = self.working_dir / "pool_dereg_tx.raw"
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
+        change = utxo_total - min_fee
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
-            f"--tx-out {payment_addr}+{utxo_total - min_fee} --ttl {ttl} "
+            f"{_change_arg(payment_addr, change)}--ttl {ttl} "
             f"--fee {min_fee} --out-file {tx_raw_file} "
             f"--certificate-file {pool_dereg}"
         )
 
         # Sign it with both the payment signing key and the cold signing key.
-        tx_signed_file = self.working_dir / "pool_dereg_tx.signed"
+        tx_signed_file = self.working_dir / (tx_name + ".signed")
         self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_raw_file} "
-            f"--signing-key-file {payment_skey} "
-            f"--signing-key-file {cold_skey} "
-            f"{self.network} --out-file {tx_signed_file}"
+            self._sign_args(
+                tx_raw_file, [payment_skey, cold_skey], tx_signed_file
+            )
         )
 
         # Submit the transaction
@@ -1868,10 +2972,11 @@ class ShelleyTools:
         str
             The stake pool id.
         """
-        result = self.run_cli(
-            f"{self.cli} stake-pool id " f"--verification-key-file {cold_vkey}"
+        pool_id = self._cached_key_lookup(
+            f"{self.cli} stake-pool id --verification-key-file {cold_vkey}",
+            "stake-pool-id",
+            cold_vkey,
         )
-        pool_id = result.stdout
         return pool_id
 
     def claim_staking_rewards(
@@ -1928,60 +3033,44 @@ class ShelleyTools:
                 f"Account {payment_addr} cannot pay tranction costs because "
                 "it does not contain any ADA."
             )
-        utxos.sort(key=lambda k: k["Lovelace"], reverse=True)
+        utxos.sort(key=itemgetter("Lovelace"), reverse=True)
 
         # Build a transaction name
-        tx_name = datetime.now().strftime("claim_rewards_%Y-%m-%d_%Hh%Mm%Ss")
+        tx_name = _tx_name("claim_rewards")
 
         # Ensure the parameters file exists
-        self.load_protocol_parameters()
+        params_file = self.load_protocol_parameters()
 
         # Determine the TTL
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
-
-        # Iterate through the UTXOs until we have enough funds to cover the
-        # transaction. Also, create the tx_in string for the transaction.
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
-        utxo_total = 0
-        tx_in_str = ""
-        for idx, utxo in enumerate(utxos):
-            utxo_count = idx + 1
-            utxo_total += int(utxo["Lovelace"])
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
-
-            # If the address receiving the funds is also paying the TX fee.
-            if payment_addr == receive_addr:
-                # Build a transaction draft
-                self.run_cli(
-                    f"{self.cli} transaction build-raw{tx_in_str} "
-                    f"--tx-out {receive_addr}+0 --ttl 0 --fee 0 "
-                    f"--withdrawal {withdrawal_str} --out-file {tx_draft_file}"
-                )
-
-                # Calculate the minimum fee
-                min_fee = self.calc_min_fee(
-                    tx_draft_file, utxo_count, tx_out_count=1, witness_count=2
-                )
-
-            # If another address is paying the TX fee.
-            else:
-                # Build a transaction draft
-                self.run_cli(
-                    f"{self.cli} transaction build-raw{tx_in_str} "
-                    f"--tx-out {receive_addr}+0 --tx-out {payment_addr}+0 "
-                    f"--ttl 0 --fee 0 --withdrawal {withdrawal_str} "
-                    f"--out-file {tx_draft_file}"
-                )
+        ttl = self.get_ttl()
 
-                # Calculate the minimum fee
-                min_fee = self.calc_min_fee(
-                    tx_draft_file, utxo_count, tx_out_count=2, witness_count=2
-                )
-
-            # If we have enough in the UTXO we are done, otherwise, continue.
-            if utxo_total > min_fee:
-                break
+        # Find the UTXOs that pay for the transaction.
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
+        draft_cmd = f"{self.cli} transaction build-raw"
+        if payment_addr == receive_addr:
+            # The address receiving the funds is also paying the TX fee.
+            tx_out_count = 1
+            draft_args = (
+                f" --tx-out {receive_addr}+0 --ttl 0 --fee 0 "
+                f"--withdrawal {withdrawal_str} --out-file {tx_draft_file}"
+            )
+        else:
+            # Another address is paying the TX fee.
+            tx_out_count = 2
+            draft_args = (
+                f" --tx-out {receive_addr}+0 --tx-out {payment_addr}+0 "
+                f"--ttl 0 --fee 0 --withdrawal {withdrawal_str} "
+                f"--out-file {tx_draft_file}"
+            )
+        _, utxo_total, min_fee, tx_in_str = self._select_fee_inputs(
+            utxos,
+            draft_cmd,
+            draft_args,
+            tx_draft_file,
+            tx_out_count=tx_out_count,
+            witness_count=2,
+            params_file=params_file,
+        )
 
         if utxo_total < min_fee:
             cost_ada = min_fee / 1_000_000
@@ -1994,7 +3083,7 @@ class ShelleyTools:
             )
 
         # Build the transaction.
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
         if payment_addr == receive_addr:
             # If the address receiving the funds is also paying the TX fee.
             self.run_cli(
@@ -2005,21 +3094,21 @@ class ShelleyTools:
             )
         else:
             # If another address is paying the TX fee.
+            change = utxo_total - min_fee
             self.run_cli(
                 f"{self.cli} transaction build-raw{tx_in_str} "
-                f"--tx-out {payment_addr}+{utxo_total - min_fee} "
+                f"{_change_arg(payment_addr, change)}"
                 f"--tx-out {receive_addr}+{rewards} "
                 f"--ttl {ttl} --fee {min_fee} --withdrawal {withdrawal_str} "
                 f"--out-file {tx_raw_file}"
             )
 
         # Sign the transaction with both the payment and stake keys.
-        tx_signed_file = Path(self.working_dir) / (tx_name + ".signed")
+        tx_signed_file = self.working_dir / (tx_name + ".signed")
         self.run_cli(
-            f"{self.cli} transaction sign "
-            f"--tx-body-file {tx_raw_file} --signing-key-file {payment_skey} "
-            f"--signing-key-file {stake_skey} {self.network} "
-            f"--out-file {tx_signed_file}"
+            self._sign_args(
+                tx_raw_file, [payment_skey, stake_skey], tx_signed_file
+            )
         )
 
         # Delete the intermediate transaction files if specified.
@@ -2033,6 +3122,49 @@ class ShelleyTools:
         else:
             print(f"Signed transaction file saved to: {tx_signed_file}")
 
+    def claim_staking_rewards_batch(self, claims, offline=False, cleanup=True):
+        """Withdraw the rewards of several staking addresses. Claims whose
+        fees are paid from different addresses spend different UTXOs, so they
+        are built and sent concurrently; claims paid from the same address
+        are sent one after another.
+
+        Parameters
+        ----------
+        claims : list
+            List of (stake_addr, stake_skey, receive_addr, payment_skey) or
+            (stake_addr, stake_skey, receive_addr, payment_skey, payment_addr)
+            tuples with the same meaning as the arguments of
+            `claim_staking_rewards`.
+        offline: bool, optional
+            Flag to indicate if the transactions are being generated offline.
+            If true (defaults to false), the transaction files are signed but
+            not sent.
+        cleanup : bool, optional
+            Flag that indicates if the temporary transaction files should be
+            removed when finished (defaults to True).
+        """
+
+        # Group the claims by the address paying the fees.
+        groups = {}
+        for claim in claims:
+            fee_addr = claim[4] if len(claim) > 4 else None
+            groups.setdefault(fee_addr or claim[2], []).append(claim)
+
+        def claim_group(group):
+            for claim in group:
+                self.claim_staking_rewards(
+                    *claim, offline=offline, cleanup=cleanup
+                )
+
+        workers = min(32, len(groups)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(claim_group, group)
+                for group in groups.values()
+            ]
+        for future in futures:
+            future.result()
+
     def convert_itn_keys(self, itn_prv_key, itn_pub_key, folder=None) -> str:
         """Convert ITN account keys to Shelley staking keys.
 
@@ -2058,33 +3190,27 @@ class ShelleyTools:
 
         # Get a working directory to store the generated files and make sure
         # the directory exists.
-        if folder is None:
-            folder = self.working_dir
-        else:
-            folder = Path(folder)
-            if self.ssh is None:
-                folder.mkdir(parents=True, exist_ok=True)
-            else:
-                self.run_cli(f'mkdir -p "{folder}"')
+        folder = self._ensure_folder(folder)
 
-        # Open the private key file to check its format.
-        prvkey = open(itn_prv_key, "r").read()
+        # Read the start of the private key file to check its format.
+        with open(itn_prv_key, "rb") as infile:
+            head = infile.read(16)
 
         # Convert the private key
         skey_file = folder / (Path(itn_prv_key).stem + "_shelley_staking.skey")
-        if prvkey[:8] == "ed25519e":
+        if head.startswith(b"ed25519e"):
             self.run_cli(
                 f"{self.cli} key convert-itn-extended-key "
                 f"--itn-signing-key-file {itn_prv_key} "
                 f"--out-file {skey_file}"
             )
-        elif prvkey[:8] == "ed25519b":
+        elif head.startswith(b"ed25519b"):
             self.run_cli(
                 f"{self.cli} key convert-itn-bip32-key "
                 f"--itn-signing-key-file {itn_prv_key} "
                 f"--out-file {skey_file}"
             )
-        elif prvkey[:7] == "ed25519":
+        elif head.startswith(b"ed25519"):
             self.run_cli(
                 f"{self.cli} key convert-itn-key "
                 f"--itn-signing-key-file {itn_prv_key} "
@@ -2128,15 +3254,15 @@ class ShelleyTools:
         """
         result = self.run_cli(
             f"{self.cli} query stake-address-info --address "
-            f"{stake_addr} {self.network}"
+            f"{stake_addr} {self.network}",
+            retry=True,
         )
         if "Failed" in result.stdout:
             raise ShelleyError(result.stdout)
-        if len(result.stderr) > 0:
+        if result.returncode != 0:
             raise ShelleyError(result.stderr)
-        info = json.loads(result.stdout)
-        balance = sum(b["rewardAccountBalance"] for b in info)
-        return balance
+        info = _json_loads(result.stdout)
+        return sum(map(itemgetter("rewardAccountBalance"), info))
 
     def empty_account(
         self, to_addr, from_addr, key_file, offline=False, cleanup=True
@@ -2160,20 +3286,43 @@ class ShelleyTools:
             removed when finished (defaults to True).
         """
 
-        # Get the address balance
-        bal = self.query_balance(from_addr)
+        # Get a list of UTxOs. A transaction can only spend so many of them,
+        # so larger accounts are emptied with several transactions.
+        utxos = self.get_utxos(from_addr)
+        max_count = self._max_tx_inputs(tx_out_count=1, witness_count=1)
+        batches = [
+            utxos[start : start + max_count]
+            for start in range(0, len(utxos), max_count)
+        ]
+
+        # Determine the slot where the transaction will become invalid. Get the
+        # current slot number and add a buffer to it.
+        ttl = self.get_ttl()
+
+        for batch in batches or [[]]:
+            self._empty_utxos(
+                batch, ttl, to_addr, from_addr, key_file, offline, cleanup
+            )
+
+    def _empty_utxos(
+        self, utxos, ttl, to_addr, from_addr, key_file, offline, cleanup
+    ):
+        """Send the value of the given UTXOs, less the fee, in a single
+        transaction. Helper for `empty_account`.
+        """
+        # Send the whole value of the UTxOs (less the fee) to the address.
+        bal = sum(utxo["Lovelace"] for utxo in utxos)
 
         # Build a transaction name
-        tx_name = datetime.now().strftime("empty_acct_%Y-%m-%d_%Hh%Mm%Ss")
+        tx_name = _tx_name("empty_acct")
 
-        # Get a list of UTxOs and create the tx_in string.
-        tx_in_str = ""
-        utxos = self.get_utxos(from_addr)
-        for utxo in utxos:
-            tx_in_str += f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}"
+        # Create the tx_in string.
+        tx_in_str = "".join(
+            f" --tx-in {utxo['TxHash']}#{utxo['TxIx']}" for utxo in utxos
+        )
 
         # Build a transaction draft
-        tx_draft_file = Path(self.working_dir) / (tx_name + ".draft")
+        tx_draft_file = self.working_dir / (tx_name + ".draft")
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
             f"--tx-out {to_addr}+0 "
@@ -2195,13 +3344,8 @@ class ShelleyTools:
             # Maybe this should fail more gracefully, but higher level logic
             # can also just catch the error and handle it.
 
-        # Determine the slot where the transaction will become invalid. Get the
-        # current slot number and add a buffer to it.
-        tip = self.get_tip()
-        ttl = tip + self.ttl_buffer
-
         # Build the transaction
-        tx_raw_file = Path(self.working_dir) / (tx_name + ".raw")
+        tx_raw_file = self.working_dir / (tx_name + ".raw")
         self.run_cli(
             f"{self.cli} transaction build-raw{tx_in_str} "
             f"--tx-out {to_addr}+{(bal - min_fee):.0f} "
@@ -2213,6 +3357,7 @@ class ShelleyTools:
 
         # Delete the intermediate transaction files if specified.
         if cleanup:
+            self._cleanup_file(tx_draft_file)
             self._cleanup_file(tx_raw_file)
 
         # Submit the transaction
@@ -27,5 +27,6 @@ setup(
     packages=["cardano_tools"],
     include_package_data=True,
     install_requires=["fabric", "requests"],
+    extras_require={"orjson": ["orjson"]},
     entry_points={},
 )